@@ -186,14 +186,11 @@ class SunshineRoomTextChannel(telepathy.server.ChannelTypeText, telepathy.server
                 for rhandle in self.contacts:
                     recipients.append(rhandle.name)
 
-            for nr in recipients:
-                print nr
-                recs_tmp = sorted(recipients)
-                recs_tmp.remove(nr)
-
-                logger.info("Sending message to %s, id %s, body: '%s'" % (str(nr), str(self.handle.id), unicode(text)))
-                msg = text.encode('windows-1250')
-                self.conn.gadu_client.sendToConf(int(nr), str(text), str(msg), recs_tmp)
+            logger.info("Sending message to %s, id %s, body: '%s'" % (', '.join(map(str, recipients)), str(self.handle.id), unicode(text)))
+            msg = text.encode('windows-1250')
+            # copies for all recipients are sent by a producer, that waits
+            # when the connection is congested
+            self.conn.gadu_client.sendToConference(str(text), str(msg), recipients)
         else:
             raise telepathy.NotImplemented("Unhandled message type")
         self.Sent(int(time.time()), message_type, text)
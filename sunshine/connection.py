@@ -27,6 +27,7 @@ import xml.etree.ElementTree as ET
 from sunshine.util.config import SunshineConfig
 
 from sunshine.lqsoft.pygadu.twisted_protocol import GaduClient
+from sunshine.lqsoft.pygadu.replay import CaptureWriter
 from sunshine.lqsoft.pygadu.models import GaduProfile, GaduContact, GaduContactGroup
 
 from sunshine.lqsoft.gaduapi import *
@@ -83,7 +84,14 @@ class GaduClientFactory(protocol.ClientFactory):
 
     def buildProtocol(self, addr):
         # connect using current selected profile
-        return GaduClient(self.config)
+        client = GaduClient(self.config)
+        capture = os.getenv('SUNSHINE_CAPTURE')
+        if capture:
+            # one file per connection - accounts share the process
+            capture = '%s.%d.%d' % (capture, self.config.uin, int(time.time()))
+            logger.info('Capturing received data to %s.' % capture)
+            client.capture = CaptureWriter(open(capture, 'wb'))
+        return client
 
     def startedConnecting(self, connector):
         logger.info('Started to connect.')
@@ -16,15 +16,143 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
+import dbus
+import json
+import logging
 import telepathy
 
+from twisted.internet import task
+
+from sunshine.lqsoft.cstruct.common import DecodeStatistics, set_tracer, get_tracer
+from sunshine.lqsoft.pygadu import metrics
+
+SUNSHINE_DEBUG = 'org.freedesktop.Telepathy.Sunshine.Debug'
+
+traffic_logger = logging.getLogger('Sunshine.Traffic')
+
 class SunshineDebug(telepathy.server.Debug):
     """Sunshine debug interface
 
-    Implements the org.freedesktop.Telepathy.Debug interface"""
+    Implements the org.freedesktop.Telepathy.Debug interface, plus
+    Sunshine specific protocol instrumentation"""
 
     def __init__(self, conn_manager):
         telepathy.server.Debug.__init__(self, conn_manager)
+        self.decode_stats = DecodeStatistics()
+        self.snapshot_loop = None
+        self.snapshot_interval = 0
+
+        self._implement_property_get(SUNSHINE_DEBUG, {
+            'DecodeTracing': lambda: dbus.Boolean(self.decode_tracing),
+            'DecodeStatistics': self.get_decode_statistics,
+            'TrafficStatistics': self.get_traffic_statistics,
+            'RejectedFrames': self.get_rejected_frames,
+            'LatencyHistograms': self.get_latency_histograms,
+            'LatencyBuckets': lambda: dbus.Array(metrics.BUCKETS, signature='d'),
+            'OutgoingQueue': self.get_outgoing_queue,
+            'TrafficSnapshotInterval': lambda: dbus.UInt32(self.snapshot_interval),
+            'LatencyTiming': lambda: dbus.Boolean(metrics.get_timing()),
+        })
+        self._implement_property_set(SUNSHINE_DEBUG, {
+            'DecodeTracing': self.set_decode_tracing,
+            'TrafficSnapshotInterval': self.set_snapshot_interval,
+            'LatencyTiming': metrics.set_timing,
+        })
+
+    @property
+    def decode_tracing(self):
+        return get_tracer() is self.decode_stats
+
+    def set_decode_tracing(self, value):
+        if value:
+            self.decode_stats.reset()
+            set_tracer(self.decode_stats)
+        elif self.decode_tracing:
+            set_tracer(None)
+
+    def get_decode_statistics(self):
+        stats = dbus.Dictionary({}, signature='s(ttd)')
+        for (name, (count, size, elapsed)) in self.decode_stats.snapshot().iteritems():
+            stats[name] = dbus.Struct((dbus.UInt64(count), dbus.UInt64(size), \
+                dbus.Double(elapsed)), signature='ttd')
+        return stats
+
+    def get_traffic_statistics(self):
+        """packet class name -> (packets in, bytes in, packets out, bytes out)
+            of all the connections"""
+        totals = {}
+        for (_, stats) in metrics.connections():
+            for (i, counters) in ((0, stats.inbound), (2, stats.outbound)):
+                for (name, (packets, size)) in counters.iteritems():
+                    entry = totals.setdefault(name, [0, 0, 0, 0])
+                    entry[i] += packets
+                    entry[i + 1] += size
+
+        traffic = dbus.Dictionary({}, signature='s(tttt)')
+        for (name, entry) in totals.iteritems():
+            traffic[name] = dbus.Struct(map(dbus.UInt64, entry), signature='tttt')
+        return traffic
+
+    def get_rejected_frames(self):
+        """packet class name -> (frames, bytes) of received frames too short
+            to be decoded, of all the connections"""
+        totals = {}
+        for (_, stats) in metrics.connections():
+            for (name, (frames, size)) in stats.rejected.iteritems():
+                entry = totals.setdefault(name, [0, 0])
+                entry[0] += frames
+                entry[1] += size
+
+        rejected = dbus.Dictionary({}, signature='s(tt)')
+        for (name, entry) in totals.iteritems():
+            rejected[name] = dbus.Struct(map(dbus.UInt64, entry), signature='tt')
+        return rejected
+
+    def get_latency_histograms(self):
+        """'decode/', 'handler/' or 'queue_wait/' + packet class name ->
+            (count, seconds, counts in LatencyBuckets) of all the connections"""
+        totals = {}
+        for (_, stats) in metrics.connections():
+            for kind in ('decode', 'handler', 'queue_wait'):
+                for (name, histogram) in getattr(stats, kind).iteritems():
+                    total = totals.setdefault(kind + '/' + name, metrics.Histogram())
+                    total.count += histogram.count
+                    total.total += histogram.total
+                    total.buckets = [a + b for (a, b) in zip(total.buckets, histogram.buckets)]
+
+        histograms = dbus.Dictionary({}, signature='s(tdat)')
+        for (name, histogram) in totals.iteritems():
+            histograms[name] = dbus.Struct((dbus.UInt64(histogram.count), \
+                dbus.Double(histogram.total), dbus.Array(histogram.buckets, signature='t')), \
+                signature='tdat')
+        return histograms
+
+    def get_outgoing_queue(self):
+        """(packets, bytes, peak bytes) waiting to be sent, of all the connections"""
+        packets, size, peak = 0, 0, 0
+        for (client, _) in metrics.connections():
+            depth = getattr(client, 'outgoing_depth', (0, 0))
+            packets += depth[0]
+            size += depth[1]
+            peak = max(peak, getattr(client, 'outgoing_peak', 0))
+        return dbus.Struct(map(dbus.UInt64, (packets, size, peak)), signature='ttt')
+
+    def set_snapshot_interval(self, value):
+        """Log a JSON snapshot of every connection's statistics each value
+            seconds, 0 turns it off"""
+        if self.snapshot_loop is not None:
+            self.snapshot_loop.stop()
+            self.snapshot_loop = None
+        self.snapshot_interval = int(value)
+        if self.snapshot_interval > 0:
+            self.snapshot_loop = task.LoopingCall(self.dump_traffic_snapshot)
+            self.snapshot_loop.start(self.snapshot_interval, now=False)
+
+    def dump_traffic_snapshot(self):
+        for (client, stats) in metrics.connections():
+            snapshot = stats.snapshot()
+            snapshot['outgoing_queue'] = getattr(client, 'outgoing_depth', (0, 0))
+            traffic_logger.info(json.dumps(snapshot, sort_keys=True))
 
     def get_record_name(self, record):
         name = record.name
@@ -5,11 +5,33 @@ __author__="lreqc"
 __date__ ="$2009-07-19 07:48:34$"
 
 import sunshine.lqsoft.cstruct.constraints as const
-import struct,sys
+import struct,sys,time
+import functools
+from itertools import izip
 
 def log(msg):
     sys.stderr.write(msg+'\n')
 
+def reserve(buffer, size):
+    """Make sure the bytearray is at least size bytes long."""
+    missing = size - len(buffer)
+    if missing > 0:
+        buffer.extend( bytearray(missing) )
+
+def buffer_find(data, char, start=0):
+    """Like str.find(), but works on memoryviews too - without copying
+        the whole tail of the buffer."""
+    if not isinstance(data, memoryview):
+        return data.find(char, start)
+
+    length = len(data)
+    while start < length:
+        pos = data[start:start+256].tobytes().find(char)
+        if pos >= 0:
+            return start + pos
+        start += 256
+    return -1
+
 
 class ICField(object):
 
@@ -22,17 +44,58 @@ class ICField(object):
     def pack(self, obj, offset, **opts):
         pass
 
+    def pack_into(self, obj, buffer, pos, base):
+        pass
+
     def unpack(self, obj, data, pos):
         pass
 
+    def unpack_last(self, obj, data, pos):
+        """Unpack the last field of a lazily unpacked structure - the end
+            offset may be None, as nothing needs it."""
+        return self.unpack(obj, data, pos)
+
     def get_value(self, obj, current_value):
         pass
 
     def set_value(self, obj, new_value):
         pass
 
+    def trusted_value(self, obj, new_value):
+        """Like set_value(), but for a value just unpacked by the field,
+            which doesn't need to be validated again."""
+        pass
+
+    def static_size(self):
+        """Returns (minimum size, is the size fixed) of the packed field,
+            as far as it can be told from the class definition alone."""
+        return (0, False)
+
+    def run_format(self):
+        """Format character of a fixed-size field, that can be packed together
+            with it's neighbours. None, if the field needs special treatment."""
+        return None
+
+    def compile(self):
+        """Called by MetaStruct once the field is complete, so it can
+            prepare faster code paths."""
+        pass
+
+    def unpack_source(self, gen):
+        """Emit the code unpacking this field into a generated function
+            (see SourceBuilder). Returns False, if the field can't be compiled."""
+        return False
+
+    def pack_source(self, gen):
+        """Emit the code packing this field into a generated function.
+            Returns False, if the field can't be compiled."""
+        return False
+
 
 class CField(ICField):
+    is_run = False
+    # name of the field, that stores this field's offset
+    offset_ref = None
 
     KEYWORDS = {
         'offset': const.OffsetConstraint,
@@ -44,6 +107,8 @@ class CField(ICField):
         self.default = default
         self.constraints = []        
         self.ommit = []
+        self._pack_hooks = None
+        self._validate = None
 
         for (key,value) in kwargs.iteritems():
             #if key == 'nullable':
@@ -62,6 +127,9 @@ class CField(ICField):
         self.nullable = bool(self.ommit)
 
     def add_constraint(self, constr):
+        if isinstance(self.constraints, tuple):
+            raise TypeError("Field %s is already compiled, it's constraints can't be changed." \
+                % self.name)
         # add constraint
         # lame version - should be a balanced tree
         index = 0
@@ -71,6 +139,52 @@ class CField(ICField):
             index += 1
         self.constraints.insert(index, constr)
 
+        if isinstance(constr, const.OffsetConstraint) and constr.field_ref:
+            self.offset_ref = constr.field_ref
+
+    def compile(self):
+        """Compile the constraint chain: on_value_set() of all constraints
+            becomes a single validator function and the constraints, that
+            have nothing to do during packing or unpacking, are skipped.
+            The compiled code wouldn't see later changes, so the constraints
+            are frozen into a tuple - add_constraint() raises TypeError."""
+        self.constraints = tuple(self.constraints)
+        checks = []
+        for c in self.constraints:
+            check = c.compile_check(self)
+            if check is not None:
+                checks.append(check)
+        self._validate = const.chain_checks(checks)
+        self._pack_hooks = [c for c in reversed(self.constraints) if c.has_pack_hook()]
+
+        decoder = self._compile_unpack([c for c in self.constraints if c.checks_unpack])
+        if decoder is not None:
+            self.unpack = decoder
+
+    def _compile_unpack(self, checks):
+        """Returns a specialized unpack(obj, data, pos) function, given the
+            constraints to check before unpacking - or None to use the generic
+            one."""
+        return None
+
+    def unpack_source(self, gen):
+        # call the field's own unpack(), with the values decoded so far,
+        # if any of the constraints needs them
+        obj = 'None'
+        for c in self.constraints:
+            refs = c.unpack_refs()
+            if refs is None or refs:
+                if not gen.decoded.issuperset(refs or ()):
+                    return False
+                obj = gen.values()
+        gen.emit('%s, pos = %s(%s, data, pos)' % \
+            (gen.local(self.name), gen.bind(self.unpack), obj))
+        return True
+
+    def pack_source(self, gen):
+        gen.emit('pos = %s(self, buffer, pos, base)' % gen.bind(self.pack_into))
+        return True
+
     def _before_unpack(self, opts):
         """Prepare the data for unpacking."""
         for c in self.constraints:
@@ -107,6 +221,28 @@ class CField(ICField):
 
         return struct.pack( self._format_string(opts), value)
 
+    def pack_into(self, obj, buffer, pos, base):
+        """Pack the field into a bytearray at pos, where pos - base is the
+            offset of the field. The buffer is extended as needed.
+            Returns the position after the field."""
+        data = self.pack(obj, pos - base)
+        end = pos + len(data)
+        buffer[pos:end] = data
+        return end
+
+    def _pack_opts(self, obj, offset):
+        """Run the pack constraints for pack_into(). Returns None, if the
+            field is ommited."""
+        value = getattr(obj, self.name)
+        if (value == None) and self.nullable:
+            return None
+
+        opts = {'field': self, 'obj': obj, 'value': value, 'offset': offset}
+        for c in (self._pack_hooks if self._pack_hooks is not None \
+          else reversed(self.constraints)):
+            c.pack(opts)
+        return opts
+
     def unpack(self, obj, data, pos):
         """Unpack the given byte buffer into this field, starting at pos"""
         # before we unpack we need to check things like:
@@ -140,6 +276,9 @@ class CField(ICField):
         if (new_value == None) and self.nullable:
             return None
 
+        if self._validate is not None:
+            return self._validate(obj, new_value)
+
         # the new value is not yet set on the object
         opts = {'field': self, 'obj': obj, 'value': new_value}      
   
@@ -149,6 +288,9 @@ class CField(ICField):
             
         return opts['value']
 
+    def trusted_value(self, obj, new_value):
+        return new_value
+
     def __str__(self):
         return str(self.name)
 
@@ -162,16 +304,25 @@ class MetaStruct(type):
         for (field_name, field_value) in cdict.iteritems():
             if isinstance(field_value, CField):
                 field_value.name = field_name
+                field_value.compile()
                 fields.append(field_value)
                 #internal_dict[field_name] = field_value
-                ndict[field_name] = property( \
-                    MetaStruct.getter_for(field_value), \
-                    MetaStruct.setter_for(field_value) )
             else:
                 ndict[field_name] = field_value
 
+        # field values are stored in slots, instead of a per-instance dict
+        if not ndict.has_key('__slots__'):
+            ndict['__slots__'] = tuple('_' + field.name for field in fields)
+
         klass = type.__new__(cls, name, bases, ndict)
 
+        # the properties use the slot descriptors directly
+        for field in fields:
+            storage = getattr(klass, '_' + field.name)
+            setattr(klass, field.name, property( \
+                MetaStruct.getter_for(field, storage), \
+                MetaStruct.setter_for(field, storage) ))
+
         #old_dict = getattr(klass, '_internal', {})
         #internal_dict.update(old_dict)
         #setattr(klass, '_internal', internal_dict)
@@ -181,63 +332,306 @@ class MetaStruct(type):
         order = getattr(klass, '_field_order', [])
         order = order + fields
         setattr(klass, '_field_order', order)
+        setattr(klass, '_field_names', frozenset(field.name for field in order))
+        setattr(klass, '_layout', MetaStruct.layout_for(order))
+        setattr(klass, '_offset_refs', \
+            frozenset(field.offset_ref for field in order if field.offset_ref))
+        setattr(klass, '_storage', [MetaStruct.storage_for(klass, field) for field in order])
+
+        sizes = [field.static_size() for field in order]
+        setattr(klass, 'static_size', sum(size for (size, fixed) in sizes))
+        setattr(klass, 'is_fixed_size', all(fixed for (size, fixed) in sizes))
         return klass
 
+    @staticmethod
+    def storage_for(klass, field):
+        """Returns (name, store, adopt) used to fill in a decoded field:
+            store(obj, value) writes the backing slot, adopt is the field's
+            trusted_value() - or None, if the value is stored as it is."""
+        store = getattr(klass, '_' + field.name).__set__
+        if field.__class__.trusted_value == CField.trusted_value:
+            return (field.name, store, None)
+        return (field.name, store, field.trusted_value)
 
     @staticmethod
-    def getter_for(field):
+    def layout_for(order):
+        """Group adjacent fixed-size fields into runs, so that each run
+            can be handled by a single struct.Struct call."""
+        layout = []
+        run = []
+        for field in order + [None]:
+            if field is not None and field.run_format() is not None:
+                run.append(field)
+                continue
+
+            if len(run) > 1:
+                layout.append( FixedRun(run) )
+            else:
+                layout.extend(run)
+            run = []
+
+            if field is not None:
+                layout.append(field)
+        return layout
+
+
+    @staticmethod
+    def generate(klass):
+        """Generate decode(data, pos) and pack_into(self, buffer, pos, base)
+            functions specialized for the class, in the style of namedtuple.
+            If some field can't be compiled, the interpreted version is
+            used instead."""
+        gen = SourceBuilder(klass.__name__)
+        for step in klass._layout:
+            if not step.unpack_source(gen):
+                decode = functools.partial(_interpreted_decode, klass)
+                break
+            gen.decoded.update(step.names if step.is_run else (step.name,))
+        else:
+            gen.construct(klass, 'obj')
+            gen.emit('return obj, pos')
+            decode = gen.build('decode(data, pos)')
+
+        # back-patching of offsets is left to the interpreter
+        gen = SourceBuilder(klass.__name__)
+        if klass._offset_refs or \
+          not all(step.pack_source(gen) for step in klass._layout):
+            pack_into = _interpreted_pack_into
+        else:
+            gen.emit('return pos')
+            pack_into = gen.build('pack_into(self, buffer, pos, base)')
+        return (decode, pack_into)
+
+    @staticmethod
+    def getter_for(field, storage):
+        if field.__class__.get_value == CField.get_value:
+            # the field doesn't transform the value
+            return storage.__get__
+
+        get_value, get_storage = field.get_value, storage.__get__
         def getter(self):
-            return field.get_value(self, getattr(self, '_' + field.name))
+            return get_value(self, get_storage(self))
         return getter
 
     @staticmethod
-    def setter_for(field):
+    def setter_for(field, storage):
+        set_value, set_storage = field.set_value, storage.__set__
         def setter(self, value):
             # log("Called setter on %r with %r" % (self, name))
-            return setattr(self, '_' + field.name, field.set_value(self, value))
+            if self._lazy is not None:
+                # don't let the pending decode overwrite the new value
+                self._decode_until(None)
+            set_storage(self, set_value(self, value))
         return setter
 
 class CStruct(object):
     __metaclass__ = MetaStruct
 
+    # (data, offset, layout index) of a lazily unpacked instance,
+    # that still has fields to decode
+    __slots__ = ('_lazy',)
+
     def __init__(self, **kwargs):
+        self._lazy = None
         for field in self._field_order:            
             setattr(self, field.name, kwargs.get(field.name,field.default))
 
     def _before_pack(self, offset=0):        
-        for field in self._field_order:
+        for field in self._layout:
             offset += field.before_pack(self, offset)
         return offset
 
     def _pack(self, off=0):
         s = ''
-        for field in self._field_order:
+        for field in self._layout:
             data = field.pack(self, off)
             off += len(data)
             s += data
         return s
 
+    def _pack_into(self, buffer, pos, base):
+        refs = self._offset_refs
+        if not refs:
+            for field in self._layout:
+                pos = field.pack_into(self, buffer, pos, base)
+            return pos
+
+        # Some fields store offsets of the others, which are known only when
+        # we get there. Remember where the offset fields were written
+        # and patch them afterwards, so one pass is enough.
+        written = {}
+        for field in self._layout:
+            ref = field.offset_ref
+            if ref is not None and \
+              not (field.nullable and getattr(self, field.name) is None):
+                setattr(self, ref, pos - base)
+                if written.has_key(ref):
+                    ref_field, ref_pos = written[ref]
+                    ref_field.pack_into(self, buffer, ref_pos, base)
+
+            for name in (field.names if field.is_run else (field.name,)):
+                if name in refs:
+                    written[name] = (field, pos)
+            pos = field.pack_into(self, buffer, pos, base)
+        return pos
+
     def pack(self, offset=0):
-        self._before_pack(offset)
-        return self._pack(offset)
+        buffer = bytearray(self.static_size if self.is_fixed_size else 0)
+        self._pack_into(buffer, 0, -offset)
+        return str(buffer)
+
+    def pack_into(self, buffer, offset=0):
+        """Pack the structure into a bytearray, starting at offset. The buffer
+            is extended as needed. Returns the end offset."""
+        reserve(buffer, offset)
+        return self._pack_into(buffer, offset, offset)
 
     @classmethod
-    def unpack(cls, data, offset=0):
-        print "Unpacking class %s: offset=%d, total_buf=%d" % (cls.__name__, offset, len(data))
+    def unpack(cls, data, offset=0, lazy=False):
+        """Unpack an instance from data, starting at offset. Data can be
+            a string or anything supporting the buffer protocol - string fields
+            of the instance will hold views of it, until they are read.
+
+            In lazy mode, fields are decoded on first access and the returned
+            offset is None, as the end of the structure is not known yet."""
+        if not isinstance(data, memoryview):
+            data = memoryview(data)
+
+        if lazy:
+            instance = cls.__new__(cls)
+            instance._lazy = (data, offset, 0) if cls._layout else None
+            return instance, None
+
+        return cls._decode(data, offset)
+
+    @classmethod
+    def unpack_many(cls, data, offsets, lazy=False):
+        """Unpack a batch of instances from data. Offsets is a sequence of
+            start offsets or (start, end) pairs - in the latter case, each
+            instance sees only it's own part of the buffer. Returns a list of
+            (instance, end offset) tuples, like unpack() does. Only eager
+            decoding is batched - lazy instances are unpack()ed one by one."""
+        if not isinstance(data, memoryview):
+            data = memoryview(data)
+
+        if lazy or _tracer is not None:
+            decode = lambda data, offset: cls.unpack(data, offset, lazy)
+        else:
+            decode = cls._decoder()
+
+        result = []
+        for offset in offsets:
+            if isinstance(offset, tuple):
+                start, end = offset
+                instance, end = decode(data[start:end], 0)
+                result.append( (instance, None if end is None else start + end) )
+            else:
+                result.append( decode(data, offset) )
+        return result
+
+    @classmethod
+    def _decoder(cls):
+        """Returns the engine's decode(data, offset) function for the class."""
+        return cls._decode
+
+    @classmethod
+    def _decode(cls, data, offset):
         dict = {}
         dp = ItemWrapper(dict)
         
-        for field in cls._field_order:
-            print "Unpacking field @%d: %s" % (offset, field.name)
-            value, next_offset = field.unpack(dp, data, offset)
-            dict[field.name] = value
-            offset = next_offset
-            print "Unpacked: " + repr(value)
-
-        instance = cls(**dict)
-        print "Unpacked: " + str(instance)
-        return instance, offset
+        for field in cls._layout:
+            value, offset = field.unpack(dp, data, offset)
+            if field.is_run:
+                dict.update( izip(field.names, value) )
+            else:
+                dict[field.name] = value
+
+        return cls._trusted(dict), offset
+
+    @classmethod
+    def _trusted(cls, values):
+        """Create an instance from freshly unpacked values. Unlike the
+            constructor, this doesn't run the setters, as the values
+            came from a valid packet."""
+        instance = cls.__new__(cls)
+        instance._lazy = None
+        for (name, store, adopt) in cls._storage:
+            if adopt is None:
+                store(instance, values[name])
+            else:
+                store(instance, adopt(instance, values[name]))
+        return instance
     
+    def _decode_until(self, name):
+        """Decode pending fields of a lazy instance, up to the given field
+            (or all of them, if name is None). Returns False if there
+            was nothing to decode."""
+        if self._lazy is None:
+            return False
+
+        data, offset, index = self._lazy
+        layout = self._layout
+        last = len(layout) - 1
+        # fields can depend on previous ones, so decoding has to be in order;
+        # reads of other fields, while a field is decoded, mustn't resume it
+        self._lazy = None
+        try:
+            while index <= last:
+                pending = (data, offset, index)
+                field = layout[index]
+                if index < last:
+                    value, offset = field.unpack(self, data, offset)
+                else:
+                    value, offset = field.unpack_last(self, data, offset)
+                index += 1
+
+                if field.is_run:
+                    for (f, v) in izip(field.fields, value):
+                        setattr(self, '_' + f.name, f.trusted_value(self, v))
+                    if name in field.names:
+                        break
+                else:
+                    setattr(self, '_' + field.name, field.trusted_value(self, value))
+                    if name == field.name:
+                        break
+        except:
+            # the failed field (and the following ones) stay pending - reading
+            # them raises the error again
+            self._lazy = pending
+            raise
+
+        if index <= last:
+            self._lazy = (data, offset, index)
+        return True
+
+    def iter_items(self, name):
+        """Iterate over the items of an array field. If the structure was
+            unpacked lazily and the array wasn't decoded yet, the items are
+            decoded one at a time, as the iteration goes - without building
+            the whole list. The field itself stays undecoded."""
+        if name not in self._field_names:
+            raise AttributeError(name)
+        if self._lazy is not None:
+            layout = self._layout
+            position = [step.name for step in layout].index(name)
+            if position >= self._lazy[2]:
+                if position > self._lazy[2]:
+                    # decode everything up to the array
+                    previous = layout[position - 1]
+                    self._decode_until(previous.names[0] if previous.is_run else previous.name)
+                data, offset, index = self._lazy
+                return layout[position].iter_unpack(self, data, offset)
+        return iter(getattr(self, name))
+
+    def __getattr__(self, name):
+        # only called, when the normal lookup fails - that is, the backing
+        # attribute of a field wasn't set yet
+        field_name = name[1:] if name.startswith('_') else name
+        if field_name not in self._field_names \
+          or not self._decode_until(field_name):
+            raise AttributeError(name)
+        return getattr(self, name)
+
     def __field_value(self, field, default=None):
         return field.get_value(self, getattr(self, '_' + field.name, default))
 
@@ -248,6 +642,251 @@ class CStruct(object):
         buf += ")"
         return buf
 
+#
+# Generated code engine. The functions are generated for each class
+# on first use and cached in the class itself.
+#
+_interpreted_decode = CStruct.__dict__['_decode'].__func__
+_interpreted_pack_into = CStruct.__dict__['_pack_into']
+_interpreted_decoder = CStruct.__dict__['_decoder']
+_engine = 'interpreter'
+
+class SourceBuilder(object):
+    """Source of a function generated by MetaStruct, together with
+        the objects it refers to."""
+
+    def __init__(self, name):
+        self.name = name
+        self.lines = []
+        self.namespace = {'UnpackException': UnpackException, 'reserve': reserve, \
+            'buffer_find': buffer_find, 'ItemWrapper': ItemWrapper}
+        self.indent = 1
+        # names of the fields already unpacked into local variables
+        self.decoded = set()
+        # distinguishes locals of inlined sub-structures
+        self.prefix = ''
+        self.__blocks = []
+
+    def emit(self, line):
+        self.lines.append('    ' * self.indent + line)
+
+    def bind(self, value):
+        """Make the value visible to the generated code, returns it's name."""
+        name = '_k%d' % len(self.namespace)
+        self.namespace[name] = value
+        return name
+
+    def local(self, field_name):
+        return 'v_' + self.prefix + field_name
+
+    def construct(self, klass, target):
+        """Emit trusted construction of the structure from the locals,
+            like CStruct._trusted() does."""
+        self.emit('%s = %s.__new__(%s)' % ((target,) + (self.bind(klass),) * 2))
+        self.emit('%s._lazy = None' % target)
+        for (name, store, adopt) in klass._storage:
+            if adopt is None:
+                self.emit('%s._%s = %s' % (target, name, self.local(name)))
+            else:
+                self.emit('%s._%s = %s(%s, %s)' % (target, name, self.bind(adopt), \
+                    target, self.local(name)))
+
+    def inline(self, klass, field_name):
+        """Emit the layout of a nested structure in place, instead of calling
+            it's unpack(), and build it into the field's local. Returns False
+            and emits nothing, if some of it's fields can't be compiled.
+            Inlined structures are not seen by the decode tracer."""
+        mark, outer = len(self.lines), (self.prefix, self.decoded)
+        target = self.local(field_name)
+        self.prefix, self.decoded = self.prefix + field_name + '__', set()
+        try:
+            for step in klass._layout:
+                if not step.unpack_source(self):
+                    del self.lines[mark:]
+                    return False
+                self.decoded.update(step.names if step.is_run else (step.name,))
+            self.construct(klass, target)
+            return True
+        finally:
+            self.prefix, self.decoded = outer
+
+    def attr(self, field):
+        """Expression reading the field's value in a pack function."""
+        if field.__class__.get_value == CField.get_value:
+            return 'self._' + field.name
+        return 'self.' + field.name
+
+    def values(self):
+        """Expression wrapping the values decoded so far, like the
+            interpreter does for the fields, that refer to them."""
+        return 'ItemWrapper({%s})' % ', '.join('%r: %s' % (name, self.local(name)) \
+            for name in sorted(self.decoded))
+
+    def begin_prefix(self, field, constr):
+        """Emit a prefix check. If the field can be ommited, the code
+            that follows goes into an else block, up to end_prefix()."""
+        self.emit('if data[pos:pos+%d] != %s:' % (len(constr.prefix), self.bind(constr.prefix)))
+        ommit = constr.keyword in field.ommit
+        if ommit:
+            self.emit('    %s = None' % self.local(field.name))
+            self.emit('else:')
+            self.indent += 1
+        else:
+            self.emit('    raise UnpackException(%r, %s)' % \
+                ('Data buffer failed to satisfy constraint: ' + str(constr), self.bind(constr)))
+        self.__blocks.append(ommit)
+
+    def end_prefix(self):
+        if self.__blocks.pop():
+            self.indent -= 1
+
+    def build(self, header):
+        self.source = 'def %s:\n%s\n' % (header, '\n'.join(self.lines))
+        exec compile(self.source, '<cstruct %s>' % self.name, 'exec') in self.namespace
+        return self.namespace[header[:header.index('(')]]
+
+def _generated(klass):
+    generated = klass.__dict__.get('_generated')
+    if generated is None:
+        generated = MetaStruct.generate(klass)
+        klass._generated = generated
+    return generated
+
+def _generated_decode(cls, data, offset):
+    return _generated(cls)[0](data, offset)
+
+def _generated_decoder(cls):
+    return _generated(cls)[0]
+
+def _generated_pack_into(self, buffer, pos, base):
+    return _generated(self.__class__)[1](self, buffer, pos, base)
+
+def set_engine(name):
+    """Select how the structures are packed and eagerly unpacked:
+        'interpreter' walks the class layout field by field, 'codegen' runs
+        functions generated for each class (see MetaStruct.generate)."""
+    global _engine
+    if name == 'interpreter':
+        CStruct._decode = classmethod(_interpreted_decode)
+        CStruct._decoder = _interpreted_decoder
+        CStruct._pack_into = _interpreted_pack_into
+    elif name == 'codegen':
+        CStruct._decode = classmethod(_generated_decode)
+        CStruct._decoder = classmethod(_generated_decoder)
+        CStruct._pack_into = _generated_pack_into
+    else:
+        raise ValueError("Unknown cstruct engine: %r" % name)
+    _engine = name
+
+def get_engine():
+    return _engine
+
+#
+# Decode tracing. CStruct.unpack() is only wrapped while a tracer is installed,
+# so there is no cost at all when tracing is disabled.
+#
+_plain_unpack = CStruct.__dict__['unpack']
+_tracer = None
+
+def set_tracer(tracer):
+    """Install a callable tracer(klass, instance, start, end, elapsed), which
+        is called after every CStruct.unpack(). None removes the tracer."""
+    global _tracer
+    _tracer = tracer
+
+    if tracer is None:
+        CStruct.unpack = _plain_unpack
+        return
+
+    plain = _plain_unpack.__func__
+    def traced_unpack(cls, data, offset=0, lazy=False):
+        start = time.time()
+        instance, end = plain(cls, data, offset, lazy)
+        tracer(cls, instance, offset, end, time.time() - start)
+        return instance, end
+    CStruct.unpack = classmethod(traced_unpack)
+
+def get_tracer():
+    return _tracer
+
+def log_tracer(klass, instance, start, end, elapsed):
+    """Tracer that dumps every decoded structure to stderr."""
+    log("Unpacked %s @%d-%d in %.6fs: %s" % (klass.__name__, start, end, elapsed, instance))
+
+class DecodeStatistics(object):
+    """Tracer that counts decoded structures, consumed bytes and wall time
+        per class. Time of nested structures is included in their parent's,
+        lazily unpacked structures are counted without bytes."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.classes = {}
+
+    def __call__(self, klass, instance, start, end, elapsed):
+        entry = self.classes.get(klass.__name__)
+        if entry is None:
+            entry = self.classes[klass.__name__] = [0, 0, 0.0]
+        entry[0] += 1
+        if end is not None:
+            entry[1] += end - start
+        entry[2] += elapsed
+
+    def snapshot(self):
+        """Returns a dict: class name -> (count, bytes, seconds)"""
+        return dict( (name, tuple(entry)) for (name, entry) in self.classes.iteritems() )
+
+class FixedRun(object):
+    """A run of adjacent fixed-size fields, compiled into a single struct.Struct.
+        Behaves like a field in the class layout, but (un)packs a tuple of values."""
+    is_run = True
+    offset_ref = None
+    nullable = False
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.names = tuple(field.name for field in fields)
+        self.name = ','.join(self.names)
+        self.codec = struct.Struct('<' + ''.join(field.run_format() for field in fields))
+        self.size = self.codec.size
+
+    def before_pack(self, obj, offset, **opts):
+        return self.size
+
+    def pack(self, obj, offset, **opts):
+        return self.codec.pack( *[getattr(obj, name) for name in self.names] )
+
+    def pack_into(self, obj, buffer, pos, base):
+        reserve(buffer, pos + self.size)
+        self.codec.pack_into(buffer, pos, *[getattr(obj, name) for name in self.names])
+        return pos + self.size
+
+    def unpack(self, obj, data, pos):
+        return (self.codec.unpack_from(data, pos), pos + self.size)
+
+    def static_size(self):
+        return (self.size, True)
+
+    unpack_last = unpack
+
+    def unpack_source(self, gen):
+        gen.emit('%s, = %s(data, pos)' % (', '.join(gen.local(name) for name in self.names), \
+            gen.bind(self.codec.unpack_from)))
+        gen.emit('pos += %d' % self.size)
+        return True
+
+    def pack_source(self, gen):
+        gen.emit('end = pos + %d' % self.size)
+        gen.emit('reserve(buffer, end)')
+        gen.emit('%s(buffer, pos, %s)' % (gen.bind(self.codec.pack_into), \
+            ', '.join(gen.attr(field) for field in self.fields)))
+        gen.emit('pos = end')
+        return True
+
+    def __str__(self):
+        return self.name
+
 class ItemWrapper(object):
     """Wraps the given object (usually a dict or a list) with
         accessor methods that turn attribute calls to index calls.
@@ -295,22 +934,6 @@ class ItemWrapper(object):
         return self._object.__eq__(other)
 
 
-class ListItemWrapper(ItemWrapper):
-
-    def __getattribute__(self, name):
-        try:
-            key = int(name)
-            return self._get_action(self, name, self._object[key])
-        except ValueError:
-            return ItemWrapper.__getattribute__(self, name)
-    
-    def __setattr__(self, name, value):
-        try:
-            key = int(name)
-            self._object[key] = self._set_action(self, name, value)
-        except ValueError:
-            return ItemWrapper.__setattr__(self, name, value)    
-        
 class UnpackException(Exception):
     def __init__(self, msg, constraint):
         Exception.__init__(self, msg)
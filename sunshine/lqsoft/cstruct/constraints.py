@@ -11,6 +11,9 @@ PRIO_MAXLENGTH = 750
 PRIO_NBOUNDS = 800
 
 class IConstraint(object):
+    # does before_unpack() do anything
+    checks_unpack = False
+
     def __init__(self, priority):
         self.priority = priority
 
@@ -20,6 +23,11 @@ class IConstraint(object):
     def before_unpack(self, opts):
         return True
 
+    def unpack_refs(self):
+        """Names of the fields, that before_unpack() reads from the object
+            being unpacked - or None, if any of them can be read."""
+        return ()
+
     def pack(self, opts):
         return True
 
@@ -28,8 +36,39 @@ class IConstraint(object):
 
     def on_value_set(self, opts):
         pass
+
+    def compile_check(self, field):
+        """Returns a function check(obj, value) -> value, that does the same
+            as on_value_set(), or None if there is nothing to check."""
+        if self.__class__.on_value_set == IConstraint.on_value_set:
+            return None
+
+        on_value_set = self.on_value_set
+        def check(obj, value):
+            opts = {'field': field, 'obj': obj, 'value': value}
+            on_value_set(opts)
+            return opts['value']
+        return check
+
+    def has_pack_hook(self):
+        return self.__class__.pack != IConstraint.pack
+
+def chain_checks(checks):
+    """Combine compiled checks into one function."""
+    if not checks:
+        return lambda obj, value: value
+    if len(checks) == 1:
+        return checks[0]
+
+    def chained(obj, value):
+        for check in checks:
+            value = check(obj, value)
+        return value
+    return chained
     
 class PrefixConstraint(IConstraint):
+    checks_unpack = True
+
     def __init__(self, param, priority=PRIO_PREFIX):
         IConstraint.__init__(self, priority)
 
@@ -64,6 +103,8 @@ class OffsetConstraint(IConstraint):
             raise ValueError("Offset constraint must contain a number or a valid field name.")
         
         self.__offset = param
+        # name of the field holding the offset, if any
+        self.field_ref = param if isinstance(param, str) else None
 
     def before_upack_number(self, options):
         if self.__offset != options['offset']:
@@ -102,6 +143,15 @@ class ValueTypeConstraint(IConstraint):
             raise ValueError("Field %s accepts only instances of %s as value."\
                 % (opts['field'].name, self._klass.__name__) )
 
+    def compile_check(self, field):
+        klass = self._klass
+        def check(obj, value):
+            if not isinstance(value, klass):
+                raise ValueError("Field %s accepts only instances of %s as value."\
+                    % (field.name, klass.__name__) )
+            return value
+        return check
+
 class NumericBounds(IConstraint):
     BOUND_FOR_CTYPE = {
         'int':      (-(2**31)+1 , 2**31),
@@ -129,7 +179,18 @@ class NumericBounds(IConstraint):
             raise ValueError("Field %s - value %s out of bounds."\
                 % (opts['field'].name, opts['value']) )
 
+    def compile_check(self, field):
+        lbound, ubound = self._lbound, self._ubound
+        def check(obj, value):
+            if not (lbound <= value <= ubound):
+                raise ValueError("Field %s - value %s out of bounds."\
+                    % (field.name, value) )
+            return value
+        return check
+
 class LengthConstraint(IConstraint):
+    checks_unpack = True
+
     def __init__(self, length, padding_func, priority=PRIO_LENGTH, opt_name='length'):
         IConstraint.__init__(self, priority)
 
@@ -162,6 +223,44 @@ class LengthConstraint(IConstraint):
             opts['padding'] = (self.__length - L)
             self.__padding_func(opts)
 
+    def compile_check(self, field):
+        length = self.__length
+        if isinstance(length, property):
+            def check(obj, value):
+                length.__set__({'field': field, 'obj': obj, 'value': value}, len(value))
+                return value
+            return check
+        if isinstance(length, str):
+            def check(obj, value):
+                setattr(obj, length, len(value))
+                return value
+            return check
+        if length < 0:
+            return None
+        return IConstraint.compile_check(self, field)
+
+    @property
+    def length(self):
+        """The length - a number, a field name or a property."""
+        return self.__length
+
+    def unpack_refs(self):
+        if isinstance(self.__length, property):
+            return None
+        if isinstance(self.__length, str):
+            return (self.__length,)
+        return ()
+
+    def compile_length(self):
+        """Returns a function length(obj, offset), that gives the length
+            of the field during unpacking."""
+        length = self.__length
+        if isinstance(length, property):
+            return lambda obj, offset: length.__get__({'obj': obj, 'offset': offset})
+        if isinstance(length, str):
+            return lambda obj, offset: getattr(obj, length)
+        return lambda obj, offset: length
+
     def before_pack(self, opts):
         # the value is about to be packed
         # nothing to do here, 'cause we ensure proper length in the trigger
@@ -4,15 +4,57 @@
 __author__ = "Łukasz Rekucki"
 __date__ = "$2009-07-19 07:46:52$"
 
-from sunshine.lqsoft.cstruct.common import ListItemWrapper, CField
+import struct
+
+from sunshine.lqsoft.cstruct.common import CField, reserve
 from sunshine.lqsoft.cstruct.constraints import *
 
 
 def array_padder(opts):
     pad = opts['padding']
-    opts['value']._extend(None for _ in xrange(0, pad))
+    # padding isn't validated
+    list.extend(opts['value'], opts['field'].padding(pad))
     # setattr(opts['obj'], '_' + opts['field'].name, value)
 
+class TypedArray(list):
+    """Value of an ArrayField - a list, that validates the items put into
+        it with the field's subfield. Reading items costs no more than
+        reading them from a plain list."""
+    __slots__ = ('_field', '_owner')
+
+    def __init__(self, items=(), field=None, owner=None):
+        list.__init__(self, items)
+        self._field = field
+        self._owner = owner
+
+    def _checked(self, values):
+        values = list(values)
+        if self._field is not None:
+            values = self._field.check_items(self._owner, values)
+        return values
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            list.__setitem__(self, index, self._checked(value))
+        else:
+            list.__setitem__(self, index, self._checked((value,))[0])
+
+    def __setslice__(self, i, j, values):
+        list.__setslice__(self, i, j, self._checked(values))
+
+    def append(self, value):
+        list.append(self, self._checked((value,))[0])
+
+    def insert(self, index, value):
+        list.insert(self, index, self._checked((value,))[0])
+
+    def extend(self, values):
+        list.extend(self, self._checked(values))
+
+    def __iadd__(self, values):
+        self.extend(values)
+        return self
+
 class ArrayField(CField):
     KEYWORDS = dict(CField.KEYWORDS,
         length= lambda lv: LengthConstraint(\
@@ -22,6 +64,27 @@ class ArrayField(CField):
         CField.__init__(self, idx, default, **dict(kwargs, length=length) )
         self.__subfield = subfield
 
+        # arrays of plain numbers are handled in bulk, with one struct call
+        self.__item_format = subfield.run_format()
+        if self.__item_format is not None:
+            self.__item_size = struct.calcsize('<' + self.__item_format)
+
+    def compile(self):
+        CField.compile(self)
+        # the subfield reports errors with the array's name
+        self.__subfield.name = self.name
+        self.__subfield.compile()
+
+        # subfields access their value as an attribute of a structure,
+        # so items are passed to them in a holder
+        self.__holder = type('ArrayItem', (object,), \
+            {'__slots__': (self.name, '_' + self.name)})
+
+    def __hold(self, item):
+        holder = self.__holder()
+        setattr(holder, self.name, item)
+        return holder
+
     # packing
     def before_pack(self, obj, offset, **opts):
         value = getattr(obj, self.name)
@@ -33,12 +96,13 @@ class ArrayField(CField):
         for c in reversed(self.constraints):
             c.before_pack(opts)     
 
+        if self.__item_format is not None:
+            return opts['length'] * self.__item_size
+
         data_len = 0
         off = offset
-        for i in xrange(0, opts['length']):
-            # map the field to index i
-            self.__subfield.name = str(i)
-            sf_len = self.__subfield.before_pack(value, off)
+        for item in value[:opts['length']]:
+            sf_len = self.__subfield.before_pack(self.__hold(item), off)
             data_len += sf_len
             off += sf_len
 
@@ -56,16 +120,34 @@ class ArrayField(CField):
 
         # all constraints to this field applied      
 
+        if self.__item_format is not None:
+            return struct.pack('<%d%s' % (opts['length'], self.__item_format), \
+                *value)
+
         buffer = ''
         off = offset
-        for i in xrange(0, opts['length']):
-            # map the field to index i
-            self.__subfield.name = str(i)
-            data = self.__subfield.pack(value, off)
+        for item in value[:opts['length']]:
+            data = self.__subfield.pack(self.__hold(item), off)
             off += len(data)
             buffer += data
         return buffer
 
+    def pack_into(self, obj, buffer, pos, base):
+        opts = self._pack_opts(obj, pos - base)
+        if opts is None:
+            return pos
+        value = opts['value']
+
+        if self.__item_format is not None:
+            end = pos + opts['length'] * self.__item_size
+            reserve(buffer, end)
+            struct.pack_into('<%d%s' % (opts['length'], self.__item_format), \
+                buffer, pos, *value)
+            return end
+
+        for item in value[:opts['length']]:
+            pos = self.__subfield.pack_into(self.__hold(item), buffer, pos, base)
+        return pos
 
     # unpacking
     def _retrieve_value(self, opts):
@@ -74,34 +156,71 @@ class ArrayField(CField):
         array_len = opts['length']
         offset = opts['offset']
 
+        if self.__item_format is not None:
+            if array_len < 0:
+                array_len = (data_len - offset) // self.__item_size
+            l = list(struct.unpack_from('<%d%s' % (array_len, self.__item_format), \
+                opts['data'], offset))
+            return (l, offset + array_len * self.__item_size)
+
         i = 0
         while (array_len < 0 and offset < data_len) or (0 <= i < array_len):
-            self.__subfield.name = str(i)
             v, offset = self.__subfield.unpack(opts['obj'], opts['data'], offset)
             l.append(v)
             i += 1
             
         return (l, offset)
 
-    def item_set_value(self, wrapper, item_name, new_value):
-        # let the subfield se the value - this validates
-        # print self, wrapper, item_name, new_value
-        self.__subfield.name = item_name
-        return self.__subfield.set_value(wrapper, new_value)
+    def static_size(self):
+        length = [c.length for c in self.constraints if isinstance(c, LengthConstraint)][0]
+        if self.nullable or not isinstance(length, int) or length < 0:
+            return (0, False)
+        size, fixed = self.__subfield.static_size()
+        return (length * size, fixed)
+
+    def iter_unpack(self, obj, data, pos):
+        """Like unpack(), but yields the items one by one, as they
+            are decoded."""
+        opts = {'obj': obj, 'data': data, 'offset': pos}
+        self._before_unpack(opts)
+        if opts.get('__ommit', False):
+            return
+
+        subfield, array_len = self.__subfield, opts['length']
+        data_len, i = len(data), 0
+        while (array_len < 0 and pos < data_len) or (0 <= i < array_len):
+            value, pos = subfield.unpack(obj, data, pos)
+            yield value
+            i += 1
+
+    def check_items(self, obj, items):
+        """Validate a list of new items of the array in the obj structure
+            with the subfield. Returns the values to store."""
+        if self.__item_format is not None:
+            # numbers are validated all at once
+            self.__subfield.validate_many(items)
+            return items
+        return [self.__subfield.set_value(obj, item) for item in items]
 
-    def item_get_value(self, wrapper, item_name, current_value):
-        # let the subfield se the value - this validates
-        self.__subfield.name = item_name
-        return self.__subfield.get_value(wrapper, current_value)
+    def padding(self, count):
+        """Items appended to an array shorter than the field's length"""
+        return [self.__subfield.default] * count
 
     # override set, to wrap the value
     def set_value(self, obj, value):
-        wrapper = ListItemWrapper(value)
-        wrapper._set_action = self.item_set_value
-        wrapper._get_action = self.item_get_value
-        return CField.set_value(self, obj, wrapper)
-
-    # no need to wrap the get
+        if (value == None) and self.nullable:
+            return None
+        return CField.set_value(self, obj, \
+            TypedArray(self.check_items(obj, list(value)), self, obj))
+
+    def trusted_value(self, obj, value):
+        if value is None:
+            return None
+        if self.__subfield.__class__.get_value != CField.get_value:
+            # let the subfield turn the unpacked items into values
+            get_value = self.__subfield.get_value
+            value = [get_value(self.__hold(item), item) for item in value]
+        return TypedArray(value, self, obj)
     
 
 class StructField(CField):
@@ -123,7 +242,8 @@ class StructField(CField):
         for c in reversed(self.constraints):
             c.before_pack(opts)
 
-        return value._before_pack(offset)
+        # _before_pack() returns the end offset, not the size
+        return value._before_pack(offset) - offset
 
     def pack(self, obj, offset, **opts):
         value = getattr(obj, self.name)
@@ -136,5 +256,45 @@ class StructField(CField):
 
         return value._pack(offset)
 
+    def pack_into(self, obj, buffer, pos, base):
+        opts = self._pack_opts(obj, pos - base)
+        if opts is None:
+            return pos
+        return opts['value']._pack_into(buffer, pos, base)
+
     def _retrieve_value(self, opts):
         return self._struct_klass.unpack(opts['data'], opts['offset'])
+
+    def static_size(self):
+        if self.nullable:
+            return (0, False)
+        return (self._struct_klass.static_size, self._struct_klass.is_fixed_size)
+
+    def unpack_source(self, gen):
+        checks = [c for c in self.constraints if c.checks_unpack]
+        if len(checks) > 1 or \
+          (checks and not isinstance(checks[0], PrefixConstraint)):
+            return CField.unpack_source(self, gen)
+
+        if checks:
+            gen.begin_prefix(self, checks[0])
+        if not gen.inline(self._struct_klass, self.name):
+            gen.emit('%s, pos = %s.unpack(data, pos)' % (gen.local(self.name), \
+                gen.bind(self._struct_klass)))
+        if checks:
+            gen.end_prefix()
+        return True
+
+    def pack_source(self, gen):
+        if self.nullable or self._pack_hooks:
+            return CField.pack_source(self, gen)
+        gen.emit('pos = %s._pack_into(buffer, pos, base)' % gen.attr(self))
+        return True
+
+    def unpack_last(self, obj, data, pos):
+        # nothing follows, so the sub-structure can be lazy too
+        opts = {'obj': obj, 'data': data, 'offset': pos}
+        self._before_unpack(opts)
+        if opts.get('__ommit', False):
+            return (None, pos)
+        return self._struct_klass.unpack(data, opts['offset'], lazy=True)
@@ -5,6 +5,7 @@ __author__ = "Łukasz Rekucki"
 __date__ = "$2009-07-19 07:46:52$"
 
 import numbers
+import struct
 
 from sunshine.lqsoft.cstruct.common import *
 import sunshine.lqsoft.cstruct.constraints as const
@@ -18,6 +19,7 @@ class NumericField(CField):
         CField.__init__(self, idx, default, **kwargs)
         self.add_constraint( const.ValueTypeConstraint(numbers.Real) )
         self.__ctype = kwargs.get('ctype', 'int')
+        self.__codec = struct.Struct(self._format_string(None))
 
     FMT_STRING = {
         'int': 'i',
@@ -32,8 +34,112 @@ class NumericField(CField):
         return '<' + NumericField.FMT_STRING[self.__ctype]
 
     def _retrieve_value(self, opts):
-         (v, offset) = CField._retrieve_value(self, opts)
-         return (v[0], offset)
+        offset = opts['offset']
+        return (self.__codec.unpack_from(opts['data'], offset)[0], \
+            offset + self.__codec.size)
+
+    def pack_into(self, obj, buffer, pos, base):
+        opts = self._pack_opts(obj, pos - base)
+        if opts is None:
+            return pos
+        end = pos + self.__codec.size
+        reserve(buffer, end)
+        self.__codec.pack_into(buffer, pos, opts['value'])
+        return end
+
+    def compile(self):
+        CField.compile(self)
+        if self.run_format() is None:
+            return
+
+        # a plain number - check the type and bounds inline
+        bounds = [c for c in self.constraints if isinstance(c, const.NumericBounds)]
+        if bounds:
+            lbound, ubound = bounds[0]._lbound, bounds[0]._ubound
+        Real, field = numbers.Real, self
+        def validate(obj, value):
+            if not isinstance(value, Real):
+                raise ValueError("Field %s accepts only instances of %s as value."\
+                    % (field.name, Real.__name__) )
+            if bounds and not (lbound <= value <= ubound):
+                raise ValueError("Field %s - value %s out of bounds."\
+                    % (field.name, value) )
+            return value
+        self._validate = validate
+
+    def _compile_unpack(self, checks):
+        unpack_from, size = self.__codec.unpack_from, self.__codec.size
+        if not checks:
+            def unpack(obj, data, pos):
+                return (unpack_from(data, pos)[0], pos + size)
+            return unpack
+
+        if len(checks) == 1 and isinstance(checks[0], const.PrefixConstraint):
+            constr = checks[0]
+            prefix, plen = constr.prefix, len(constr.prefix)
+            ommit = constr.keyword in self.ommit
+            def unpack(obj, data, pos):
+                if data[pos:pos+plen] != prefix:
+                    if ommit:
+                        return (None, pos)
+                    raise UnpackException('Data buffer failed to satisfy constraint: ' \
+                        + str(constr), constr)
+                return (unpack_from(data, pos)[0], pos + size)
+            return unpack
+        return None
+
+    def unpack_source(self, gen):
+        checks = [c for c in self.constraints if c.checks_unpack]
+        if len(checks) > 1 or \
+          (checks and not isinstance(checks[0], const.PrefixConstraint)):
+            return CField.unpack_source(self, gen)
+
+        if checks:
+            gen.begin_prefix(self, checks[0])
+        gen.emit('%s = %s(data, pos)[0]' % (gen.local(self.name), \
+            gen.bind(self.__codec.unpack_from)))
+        gen.emit('pos += %d' % self.__codec.size)
+        if checks:
+            gen.end_prefix()
+        return True
+
+    def pack_source(self, gen):
+        if self.nullable or self._pack_hooks:
+            return CField.pack_source(self, gen)
+
+        gen.emit('end = pos + %d' % self.__codec.size)
+        gen.emit('reserve(buffer, end)')
+        gen.emit('%s(buffer, pos, %s)' % (gen.bind(self.__codec.pack_into), gen.attr(self)))
+        gen.emit('pos = end')
+        return True
+
+    def static_size(self):
+        if self.nullable:
+            return (0, False)
+        return (self.__codec.size, True)
+
+    def validate_many(self, values):
+        """Check a whole sequence of values, like set_value() would
+            check each one of them."""
+        for v in values:
+            if not isinstance(v, numbers.Real):
+                raise ValueError("Field %s accepts only instances of %s as value."\
+                    % (self.name, numbers.Real.__name__) )
+
+        for c in self.constraints:
+            if isinstance(c, const.NumericBounds) and values:
+                c.on_value_set({'field': self, 'value': min(values)})
+                c.on_value_set({'field': self, 'value': max(values)})
+
+    def run_format(self):
+        # only plain numbers can be merged into a run - prefixes, offsets
+        # and ommiting need to be checked field by field
+        if self.nullable:
+            return None
+        for c in self.constraints:
+            if not isinstance(c, (const.ValueTypeConstraint, const.NumericBounds)):
+                return None
+        return NumericField.FMT_STRING[self.__ctype]
     
 # some usefull shorthands
 class IntField(NumericField):
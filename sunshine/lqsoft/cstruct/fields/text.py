@@ -4,7 +4,9 @@
 __author__ = "Łukasz Rekucki"
 __date__ = "$2009-07-19 09:50:34$"
 
-from sunshine.lqsoft.cstruct.common import CField, CStruct
+import struct
+
+from sunshine.lqsoft.cstruct.common import CField, CStruct, UnpackException, buffer_find, reserve
 from sunshine.lqsoft.cstruct.fields.numeric import UIntField
 from sunshine.lqsoft.cstruct.fields.complex import StructField
 
@@ -12,9 +14,55 @@ from sunshine.lqsoft.cstruct.constraints import *
 
 def string_padder(opts):
     pad = opts['padding']
-    opts['value'] += pad*'\x00'
+    if pad:
+        opts['value'] = TextField.materialize(opts['value']) + pad*'\x00'
+
+class TextField(CField):
+    """Base for fields holding byte strings. Unpacked values are kept as views
+        of the unpacked buffer and copied out only when the field is read."""
+
+    @staticmethod
+    def materialize(value):
+        if isinstance(value, memoryview):
+            return value.tobytes()
+        return value
+
+    def get_value(self, obj, current_value):
+        if isinstance(current_value, memoryview):
+            current_value = current_value.tobytes()
+            setattr(obj, '_' + self.name, current_value)
+        return current_value
+
+    def _format_string(self, opts):
+        return '<'+str(opts['length'])+'s'
+
+    def pack_into(self, obj, buffer, pos, base):
+        opts = self._pack_opts(obj, pos - base)
+        if opts is None:
+            return pos
+        end = pos + len(opts['value'])
+        buffer[pos:end] = opts['value']
+        return end
+
+    def pack_source(self, gen):
+        if self.nullable or \
+          not all(isinstance(c, LengthConstraint) for c in self._pack_hooks):
+            return CField.pack_source(self, gen)
+
+        gen.emit('value = self.%s' % self.name)
+        gen.emit('end = pos + len(value)')
+        gen.emit('buffer[pos:end] = value')
+        gen.emit('pos = end')
+        return True
+
+    def _retrieve_value(self, opts):
+        data, start = opts['data'], opts['offset']
+        end = start + opts['length']
+        if end > len(data):
+            raise UnpackException("Data buffer too short for field %s." % self.name, None)
+        return (data[start:end], end)
 
-class StringField(CField):    
+class StringField(TextField):
     KEYWORDS = dict(CField.KEYWORDS,
         length= lambda lv: LengthConstraint(\
             length=lv, padding_func=string_padder) )
@@ -29,25 +77,104 @@ class StringField(CField):
         return '<'+str(opts['length'])+'s'
 
     def _retrieve_value(self, opts):
-         (v, offset) = CField._retrieve_value(self, opts)
-         return (v[0], offset)
+        self._format_string(opts)
+        return TextField._retrieve_value(self, opts)
+
+    def _compile_unpack(self, checks):
+        if len(checks) != 1 or not isinstance(checks[0], LengthConstraint):
+            return None
+
+        length_of, field = checks[0].compile_length(), self
+        def unpack(obj, data, pos):
+            length = length_of(obj, pos)
+            if length == -1:
+                end = len(data)
+            elif length < 0:
+                raise UnpackException("Negative length of field %s." % field.name, None)
+            else:
+                end = pos + length
+                if end > len(data):
+                    raise UnpackException("Data buffer too short for field %s." \
+                        % field.name, None)
+            return (data[pos:end], end)
+        return unpack
+
+    def static_size(self):
+        lengths = [c.length for c in self.constraints if isinstance(c, LengthConstraint)]
+        if self.nullable or not isinstance(lengths[0], int) or lengths[0] < 0:
+            return (0, False)
+        return (lengths[0], True)
+
+    def unpack_source(self, gen):
+        checks = [c for c in self.constraints if c.checks_unpack]
+        if len(checks) != 1 or not isinstance(checks[0], LengthConstraint):
+            return CField.unpack_source(self, gen)
+
+        length, target = checks[0].length, gen.local(self.name)
+        too_short = 'raise UnpackException(%r, None)' % \
+            ("Data buffer too short for field %s." % self.name)
+        if length == -1:
+            gen.emit('%s = data[pos:]' % target)
+            gen.emit('pos = len(data)')
+        elif isinstance(length, int) and length >= 0:
+            gen.emit('end = pos + %d' % length)
+            gen.emit('if end > len(data): ' + too_short)
+            gen.emit('%s = data[pos:end]' % target)
+            gen.emit('pos = end')
+        elif isinstance(length, str) and length in gen.decoded:
+            gen.emit('if %s < 0:' % gen.local(length))
+            gen.emit('    if %s != -1: raise UnpackException(%r, None)' % \
+                (gen.local(length), "Negative length of field %s." % self.name))
+            gen.emit('    end = len(data)')
+            gen.emit('else:')
+            gen.emit('    end = pos + %s' % gen.local(length))
+            gen.emit('    if end > len(data): ' + too_short)
+            gen.emit('%s = data[pos:end]' % target)
+            gen.emit('pos = end')
+        else:
+            return CField.unpack_source(self, gen)
+        return True
 
   
-class NullStringField(CField):
+class NullStringField(TextField):
     KEYWORDS = dict(CField.KEYWORDS,
         max_length= lambda lv: MaxLengthConstraint(length=lv) )
-            
-    def _format_string(self, opts):
-        return '<'+str(opts['length'])+'s'
 
     def _before_unpack(self, opts):
         CField._before_unpack(self, opts)
-        try:
-            opts['length'] = opts['data'].index('\0', opts['offset']) - opts['offset'] + 1
-            if opts.has_key('max_length'):
-                opts['length'] = min(opts['max_length'], opts['length'])
-        except ValueError:
-            raise UnpackException("Unterminated null string occured.")
+        end = buffer_find(opts['data'], '\0', opts['offset'])
+        if end < 0:
+            raise UnpackException("Unterminated null string occured.", None)
+
+        opts['length'] = end - opts['offset'] + 1
+        if opts.has_key('max_length'):
+            opts['length'] = min(opts['max_length'], opts['length'])
+
+    def _compile_unpack(self, checks):
+        if checks:
+            return None
+
+        def unpack(obj, data, pos):
+            end = buffer_find(data, '\0', pos)
+            if end < 0:
+                raise UnpackException("Unterminated null string occured.", None)
+            return (data[pos:end+1], end+1)
+        return unpack
+
+    def unpack_source(self, gen):
+        if [c for c in self.constraints if c.checks_unpack]:
+            return CField.unpack_source(self, gen)
+
+        gen.emit('end = buffer_find(data, %r, pos) + 1' % '\0')
+        gen.emit('if not end: raise UnpackException(%r, None)' % \
+            "Unterminated null string occured.")
+        gen.emit('%s = data[pos:end]' % gen.local(self.name))
+        gen.emit('pos = end')
+        return True
+
+    def static_size(self):
+        # at least the terminating '\0'
+        return (0 if self.nullable else 1, False)
 
     def before_pack(self, obj, offset, **opts):
         value = getattr(obj, self.name)
@@ -57,12 +184,8 @@ class NullStringField(CField):
         value = getattr(obj, self.name)
         return CField.pack(self, obj, offset, length=len(value), **opts)
 
-    def _retrieve_value(self, opts):
-        (v, offset) = CField._retrieve_value(self, opts)
-        return (v[0], offset)
-
     def set_value(self, obj, value):
-        if not isinstance(value, str) or value[-1] != '\0':
+        if not isinstance(value, (str, memoryview)) or value[-1] != '\0':
             raise ValueError("NullStringField value must a string with last character == '\\0'.")
         
         return CField.set_value(self, obj, value)
@@ -71,8 +194,98 @@ class CStruct_VarString(CStruct):
     length = UIntField(0)
     text = StringField(1, length='length')
 
-class VarcharField(StructField):
-    def __init__(self, idx, default='', **opts):        
-        if isinstance(default, str):
-            default = CStruct_VarString(text=default)            
-        StructField.__init__(self, idx, CStruct_VarString, default, **opts)
+class VarcharField(TextField):
+    """A string prefixed with it's length - the layout of CStruct_VarString,
+        inlined into the parent structure. The value is a plain string,
+        CStruct_VarString instances are accepted too."""
+
+    LENGTH = struct.Struct('<I')
+
+    def __init__(self, idx, default='', **opts):
+        if isinstance(default, CStruct_VarString):
+            default = default.text
+        CField.__init__(self, idx, default, **opts)
+
+    def set_value(self, obj, value):
+        if isinstance(value, CStruct_VarString):
+            value = value.text
+        if not (isinstance(value, (str, memoryview)) or (value == None and self.nullable)):
+            raise ValueError("VarcharField value must be a string.")
+        return CField.set_value(self, obj, value)
+
+    def static_size(self):
+        return (0 if self.nullable else self.LENGTH.size, False)
+
+    def before_pack(self, obj, offset, **opts):
+        value = getattr(obj, self.name)
+        if (value == None) and self.nullable:
+            return 0
+        return self.LENGTH.size + len(value)
+
+    def pack(self, obj, offset, **opts):
+        opts = self._pack_opts(obj, offset)
+        if opts is None:
+            return ''
+        return self.LENGTH.pack(len(opts['value'])) + opts['value']
+
+    def pack_into(self, obj, buffer, pos, base):
+        opts = self._pack_opts(obj, pos - base)
+        if opts is None:
+            return pos
+        value = opts['value']
+        start = pos + self.LENGTH.size
+        reserve(buffer, start)
+        self.LENGTH.pack_into(buffer, pos, len(value))
+        buffer[start:start + len(value)] = value
+        return start + len(value)
+
+    def _retrieve_value(self, opts):
+        data, pos = opts['data'], opts['offset']
+        if pos + self.LENGTH.size > len(data):
+            raise UnpackException("Data buffer too short for field %s." % self.name, None)
+        opts['length'] = self.LENGTH.unpack_from(data, pos)[0]
+        opts['offset'] = pos + self.LENGTH.size
+        return TextField._retrieve_value(self, opts)
+
+    def _compile_unpack(self, checks):
+        if checks:
+            return None
+
+        unpack_from, size, field = self.LENGTH.unpack_from, self.LENGTH.size, self
+        def unpack(obj, data, pos):
+            start = pos + size
+            if start > len(data):
+                raise UnpackException("Data buffer too short for field %s." \
+                    % field.name, None)
+            end = start + unpack_from(data, pos)[0]
+            if end > len(data):
+                raise UnpackException("Data buffer too short for field %s." \
+                    % field.name, None)
+            return (data[start:end], end)
+        return unpack
+
+    def unpack_source(self, gen):
+        if [c for c in self.constraints if c.checks_unpack]:
+            return CField.unpack_source(self, gen)
+
+        too_short = 'raise UnpackException(%r, None)' % \
+            ("Data buffer too short for field %s." % self.name)
+        gen.emit('end = pos + %d' % self.LENGTH.size)
+        gen.emit('if end > len(data): ' + too_short)
+        gen.emit('pos, end = end, end + %s(data, pos)[0]' % gen.bind(self.LENGTH.unpack_from))
+        gen.emit('if end > len(data): ' + too_short)
+        gen.emit('%s = data[pos:end]' % gen.local(self.name))
+        gen.emit('pos = end')
+        return True
+
+    def pack_source(self, gen):
+        if self.nullable or self._pack_hooks:
+            return CField.pack_source(self, gen)
+
+        gen.emit('value = self.%s' % self.name)
+        gen.emit('end = pos + %d' % self.LENGTH.size)
+        gen.emit('reserve(buffer, end)')
+        gen.emit('%s(buffer, pos, len(value))' % gen.bind(self.LENGTH.pack_into))
+        gen.emit('pos = end + len(value)')
+        gen.emit('buffer[end:pos] = value')
+        return True
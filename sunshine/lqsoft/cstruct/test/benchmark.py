@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+"""Pack/unpack micro-benchmarks of all packets registered in the Resolver.
+
+Every measurement is printed as one line of JSON, so results of different
+codec versions (or engines) can be compared by a script:
+
+    python -m lqsoft.cstruct.test.benchmark --engine=codegen StatusNoticiesPacket
+
+Unpacking is measured twice: "decode" only unpacks a packet, which leaves
+string fields (and, with lazy decoding, whole structures) as views of the
+data, while "decode+materialize" also reads every field, like a handler
+using the whole packet would. Allocations are measured as "objects": the
+net number of GC tracked objects a call leaves allocated. Objects the GC
+doesn't track (like strings copied out of the data) aren't counted.
+"""
+
+import gc
+import json
+import optparse
+import sys
+import time
+
+from lqsoft.cstruct.common import CStruct, set_engine
+from lqsoft.pygadu.network import *
+from lqsoft.pygadu.packets import Resolver
+
+#
+# Payloads
+#
+def status(i):
+    return StructStatus(uin=1000000 + i, status=ChangeStatusPacket.STATUS.AVAILABLE_DESC, \
+        remote_ip=0x0100007f, remote_port=1550, image_size=0xff, \
+        description='Opis numer %d - zapraszam na http://example.com/' % i)
+
+def message(html, attrs=None):
+    plain = html.replace('<b>', '').replace('</b>', '') + '\0'
+    return StructMessage(klass=StructMessage.CLASS.CHAT, html_message=html + '\0', \
+        plain_message=plain, attrs=(attrs or StructMsgAttrs()))
+
+def conference_attrs(count):
+    attrs = StructMsgAttrs()
+    attrs.conference = StructConference(recipients=[2000000 + i for i in xrange(count)])
+    attrs.richtext = StructRichText()
+    return attrs
+
+def user_data(users, attrs):
+    return UserDataPacket(type=0x04, users=[ StructUserDataUser(uin=3000000 + u, \
+        attr=[ StructUserDataAttr(name='avatar_%d' % a, type=1, value='http://avatars.example.com/%d/%d' % (u, a)) \
+            for a in xrange(attrs) ]) for u in xrange(users) ])
+
+def contact_list(size):
+    entry = '<Contact><Guid>%08d</Guid><GGNumber>%d</GGNumber><ShowName>Kontakt</ShowName></Contact>'
+    count = size // len(entry % (0, 4000000)) + 1
+    return ''.join(entry % (i, 4000000 + i) for i in xrange(count))[:size]
+
+def logged_in():
+    packet = LoginPacket(uin=1849224, description='Jestem tutaj')
+    packet.update_hash('password', 0x12345678)
+    return packet
+
+TEXT = 'Ala ma kota, a kot ma <b>Ale</b>. ' * 8
+
+# packet class name -> [(case name, factory)]; other registered packets
+# are measured with their default values
+CASES = {
+    'WelcomePacket':        [('seed', lambda: WelcomePacket(seed=0x12345678))],
+    'MessageAckPacket':     [('ack', lambda: MessageAckPacket(msg_status=2, recipient=1849224, seq=42))],
+    'XmlEventPacket':       [('event', lambda: XmlEventPacket(data='<event><type>1</type></event>' * 10))],
+    'XmlActionPacket':      [('action', lambda: XmlActionPacket(data='<action><type>1</type></action>' * 10))],
+    'MessageInPacket':      [
+        ('plain', lambda: MessageInPacket(sender=1849224, seq=1, time=1250000000, content=message(TEXT))),
+        ('conference', lambda: MessageInPacket(sender=1849224, seq=1, time=1250000000, \
+            content=message(TEXT, conference_attrs(20)))),
+    ],
+    'StatusUpdatePacket':   [('status', lambda: StatusUpdatePacket(contact=status(0)))],
+    'StatusNoticiesPacket': [ ('%d contacts' % n, (lambda n: lambda: \
+        StatusNoticiesPacket(contacts=[status(i) for i in xrange(n)]))(n)) for n in (50, 500, 5000) ],
+    'ULReplyPacket':        [('1 MB', lambda: ULReplyPacket(type=0x06, version=7, data=contact_list(1 << 20)))],
+    'UserDataPacket':       [('20 users', lambda: user_data(20, 3))],
+    'AddNoticePacket':      [('contact', lambda: AddNoticePacket(contact=StructNotice(uin=1849224)))],
+    'RemoveNoticePacket':   [('contact', lambda: RemoveNoticePacket(contact=StructNotice(uin=1849224)))],
+    'NoticeFirstPacket':    [('400 contacts', lambda: NoticeFirstPacket( \
+        contacts=[StructNotice(uin=1000000 + i) for i in xrange(400)]))],
+    'NoticeLastPacket':     [('20 contacts', lambda: NoticeLastPacket( \
+        contacts=[StructNotice(uin=1000000 + i) for i in xrange(20)]))],
+    'MessageOutPacket':     [('chat', lambda: MessageOutPacket(recipient=1849224, seq=1, \
+        content=message(TEXT, conference_attrs(0))))],
+    'LoginPacket':          [('login', logged_in)],
+    'ChangeStatusPacket':   [('description', lambda: ChangeStatusPacket( \
+        status=ChangeStatusPacket.STATUS.AVAILABLE_DESC, description='Jestem tutaj'))],
+    'ULRequestPacket':      [('64 kB', lambda: ULRequestPacket(type=0x00, data=contact_list(1 << 16)))],
+}
+
+def cases():
+    """Yields (packet class, direction, case name, instance)"""
+    for (klass, id, is_out) in Resolver.packets():
+        for (name, factory) in CASES.get(klass.__name__, [('default', klass)]):
+            yield (klass, is_out and 'out' or 'in', name, factory())
+
+#
+# Measurement
+#
+def materialize(value):
+    """Reads all fields of a decoded structure, recursively"""
+    if isinstance(value, CStruct):
+        for field in value._field_order:
+            materialize(getattr(value, field.name))
+    elif isinstance(value, list):
+        for item in value:
+            materialize(item)
+    return value
+
+def measure(func, min_time, repeat):
+    """Returns the best time of a single call and the number of GC tracked
+        objects, that a call leaves behind (the decoded structures, wrappers
+        and such), given it's result is kept."""
+    number = 1
+    while True:
+        start = time.time()
+        for _ in xrange(number):
+            func()
+        if time.time() - start >= min_time:
+            break
+        number *= 2
+
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        for _ in xrange(number):
+            func()
+        elapsed = (time.time() - start) / number
+        best = elapsed if best is None else min(best, elapsed)
+
+    gc.collect()
+    gc.disable()
+    try:
+        before = gc.get_count()[0]
+        kept = [func() for _ in xrange(10)]
+        objects = (gc.get_count()[0] - before - 1) / 10.0
+    finally:
+        gc.enable()
+    return best, number, max(objects, 0.0)
+
+def run(engine, names, min_time, repeat, output):
+    set_engine(engine)
+    for (klass, direction, case, packet) in cases():
+        if names and klass.__name__ not in names:
+            continue
+        data = packet.pack()
+        ops = (('pack', packet.pack), ('decode', lambda: klass.unpack(data)), \
+            ('decode+materialize', lambda: materialize(klass.unpack(data)[0])))
+        for (op, func) in ops:
+            seconds, number, objects = measure(func, min_time, repeat)
+            output.write(json.dumps({
+                'engine': engine, 'packet': klass.__name__, 'direction': direction,
+                'case': case, 'op': op, 'bytes': len(data), 'calls': number,
+                'seconds': seconds, 'ops_per_sec': 1.0 / seconds if seconds else None,
+                'mb_per_sec': len(data) / seconds / (1 << 20) if seconds else None,
+                'objects': objects,
+            }, sort_keys=True) + '\n')
+            output.flush()
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [options] [packet class...]")
+    parser.add_option('-e', '--engine', action='append', choices=['interpreter', 'codegen'], \
+        help="cstruct engine to measure, can be given more than once (default: both)")
+    parser.add_option('-t', '--min-time', type='float', default=0.2, \
+        help="approximate time of a single measurement, in seconds")
+    parser.add_option('-r', '--repeat', type='int', default=3, \
+        help="number of measurements, the best one is reported")
+    (options, names) = parser.parse_args(argv)
+
+    for engine in (options.engine or ['interpreter', 'codegen']):
+        run(engine, names, options.min_time, options.repeat, sys.stdout)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
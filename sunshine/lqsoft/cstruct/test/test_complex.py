@@ -4,9 +4,9 @@
 import unittest
 import struct
 
-from lqsoft.cstruct.common import CStruct
+from lqsoft.cstruct.common import CStruct, UnpackException
 from lqsoft.cstruct.fields.complex import *
-from lqsoft.cstruct.fields.numeric import IntField, UIntField
+from lqsoft.cstruct.fields.numeric import IntField, UIntField, UByteField
 from lqsoft.cstruct.fields.text import NullStringField
 from lqsoft.cstruct.constraints import *
 
@@ -35,6 +35,15 @@ class ArrayFieldTest(unittest.TestCase):
         self.assertEqual( s.array , self.svalue)
         self.assertEqual( s.pack(), self.sdata)
 
+    def testShortArrayPack(self):
+        class TestStruct(CStruct):
+            array = ArrayField(0, length=4, subfield=IntField(0))
+            tail = UIntField(1, default=0xbebafeca)
+
+        # padded with the subfield's default
+        s = TestStruct(array=[1, 2])
+        self.assertEqual(s.pack(), struct.pack('<4iI', 1, 2, 0, 0, 0xbebafeca))
+
     def testArrayUnpack(self):
         class TestStruct(CStruct):
             array = ArrayField(0, length = self.slen, subfield=IntField(0))
@@ -45,6 +54,79 @@ class ArrayFieldTest(unittest.TestCase):
         for i in xrange(0, self.slen):
             self.assertEqual( s.array[i], self.svalue[i])
 
+    def testArrayUnpackToEnd(self):
+        class TestStruct(CStruct):
+            count = UIntField(0)
+            array = ArrayField(1, length=-1, subfield=IntField(0))
+
+        s, offset = TestStruct.unpack(struct.pack('<I', 7) + self.sdata)
+        self.assertEqual(s.count, 7)
+        self.assertEqual(s.array, self.svalue)
+        self.assertEqual(offset, 4 + len(self.sdata))
+
+    def testArrayBulkValidation(self):
+        class TestStruct(CStruct):
+            count = IntField(0)
+            array = ArrayField(1, length='count', subfield=UByteField(0))
+
+        s = TestStruct(array=[1, 2, 255])
+        self.assertEqual(s.count, 3)
+        self.assertEqual(s.pack(), struct.pack('<i3B', 3, 1, 2, 255))
+
+        self.assertRaises(ValueError, TestStruct, array=[1, 256])
+        self.assertRaises(ValueError, TestStruct, array=[1, 'kot'])
+
+    def testTrustedUnpack(self):
+        class TestStruct(CStruct):
+            count = IntField(0)
+            array = ArrayField(1, length='count', subfield=UByteField(0))
+
+        s, offset = TestStruct.unpack(struct.pack('<i3B', 3, 1, 2, 255))
+        self.assertEqual(s.array, [1, 2, 255])
+
+        # the unpacked array still validates updates
+        s.array[0] = 7
+        self.assertEqual(s.array[0], 7)
+        self.assertRaises(ValueError, s.array.__setitem__, 1, 256)
+
+    def testTypedArray(self):
+        class Item(CStruct):
+            one = IntField(0)
+
+        class TestStruct(CStruct):
+            numbers = ArrayField(0, length=-1, subfield=UByteField(0))
+            items = ArrayField(1, length=2, subfield=StructField(0, struct=Item))
+
+        s = TestStruct(numbers=[1, 2], items=[Item(one=1), Item(one=2)])
+        self.assertTrue(isinstance(s.numbers, TypedArray))
+        s.numbers.append(3)
+        s.numbers[0:1] = [7, 8]
+        self.assertEqual(s.numbers, [7, 8, 2, 3])
+        self.assertRaises(ValueError, s.numbers.append, 256)
+        self.assertRaises(ValueError, s.numbers.extend, [1, 'kot'])
+        self.assertEqual(s.numbers, [7, 8, 2, 3])
+
+        s.items[1] = Item(one=5)
+        self.assertEqual(s.pack(), struct.pack('<4Bii', 7, 8, 2, 3, 1, 5))
+
+    def testIterItems(self):
+        class Item(CStruct):
+            one = IntField(0)
+            two = IntField(1)
+
+        class TestStruct(CStruct):
+            count = UIntField(0)
+            items = ArrayField(1, length=-1, subfield=StructField(0, struct=Item))
+
+        data = struct.pack('<I', 3) + struct.pack('<6i', 1, 2, 3, 4, 5, 6)
+        s, offset = TestStruct.unpack(data, lazy=True)
+        items = s.iter_items('items')
+        self.assertEqual(s.count, 3)
+        self.assertEqual([(i.one, i.two) for i in items], [(1, 2), (3, 4), (5, 6)])
+        # the field can still be read as a whole
+        self.assertEqual([i.two for i in s.items], [2, 4, 6])
+        self.assertEqual([i.one for i in s.iter_items('items')], [1, 3, 5])
+
 class StructFieldTest(unittest.TestCase):
     
     def setUp(self):
@@ -75,6 +157,78 @@ class StructFieldTest(unittest.TestCase):
         print repr(data)
         self.assertEqual( data[4:-4], self.inner_data )
 
+    def testPackInto(self):
+        s = self.OuterStruct(inner=self.inner)
+        data = s.pack()
+
+        buffer = bytearray('HEAD')
+        end = s.pack_into(buffer, 4)
+        self.assertEqual(end, 4 + len(data))
+        self.assertEqual(str(buffer), 'HEAD' + data)
+
+        # a big enough buffer is not resized
+        buffer = bytearray(64)
+        s.pack_into(buffer, 8)
+        self.assertEqual(len(buffer), 64)
+        self.assertEqual(str(buffer[8:8+len(data)]), data)
+
+    def testLazyUnpack(self):
+        data = self.OuterStruct(inner=self.inner).pack()
+        s, offset = self.OuterStruct.unpack(data, lazy=True)
+        self.assertEqual(offset, None)
+
+        self.assertEqual(s.pad, 'KOT\0')
+        self.assertTrue(s._lazy is not None)
+        self.assertEqual(s.post, 0xbebafeca)
+        self.assertTrue(s._lazy is None)
+        self.assertEqual(s.inner.two, 42)
+
+    def testLazyUnpackNested(self):
+        class TailStruct(CStruct):
+            post = UIntField(0)
+            inner = StructField(1, struct=self.InnerStruct)
+
+        s, offset = TailStruct.unpack('\x01\x00\x00\x00' + self.inner_data, lazy=True)
+        # the last sub-structure is lazy too
+        self.assertTrue(s.inner._lazy is not None)
+        self.assertEqual(s.inner.one, 13)
+        self.assertEqual(s.inner.two, 42)
+
+        # setting a field decodes the rest first
+        s, offset = TailStruct.unpack('\x01\x00\x00\x00' + self.inner_data, lazy=True)
+        s.post = 7
+        self.assertEqual(s.inner.one, 13)
+        self.assertEqual(s.post, 7)
+
+    def testLazyUnpackTruncated(self):
+        class NamedStruct(CStruct):
+            inner = StructField(0, struct=self.InnerStruct)
+            name = NullStringField(1)
+
+        # the name is cut before it's terminating NULL
+        s, offset = NamedStruct.unpack(self.inner_data + 'Ala', lazy=True)
+        self.assertRaises(UnpackException, getattr, s, 'name')
+        # the failed field stays pending, the decoded ones are kept
+        self.assertRaises(UnpackException, getattr, s, 'name')
+        self.assertEqual(s.inner.two, 42)
+
+    def testStaticSize(self):
+        class FixedStruct(CStruct):
+            one = IntField(0)
+            inner = StructField(1, struct=self.InnerStruct)
+            array = ArrayField(2, length=3, subfield=UByteField(0))
+
+        class VarStruct(CStruct):
+            one = IntField(0, prefix__ommit='\x07')
+            inner = StructField(1, struct=FixedStruct)
+            text = NullStringField(2)
+
+        self.assertEqual((FixedStruct.static_size, FixedStruct.is_fixed_size), (15, True))
+        self.assertEqual((VarStruct.static_size, VarStruct.is_fixed_size), (16, False))
+
+        s = FixedStruct(inner=self.InnerStruct(one=1, two=2), array=[1, 2, 3])
+        self.assertEqual(len(s.pack()), FixedStruct.static_size)
+
     def testGaduMsgOut(self):
         from lqsoft.pygadu.network import *
         import time
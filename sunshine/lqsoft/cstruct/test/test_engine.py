@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+import unittest
+import struct
+import functools
+
+from lqsoft.cstruct.common import CStruct, MetaStruct, UnpackException, \
+    set_engine, get_engine
+from lqsoft.cstruct.fields.numeric import *
+from lqsoft.cstruct.fields.text import *
+from lqsoft.cstruct.fields.complex import ArrayField, StructField
+
+class Inner(CStruct):
+    kind    = UByteField(0, prefix='\x01')
+    value   = IntField(1)
+
+class Outer(CStruct):
+    magic   = UIntField(0)
+    flags   = UShortField(1)
+    count   = UByteField(2)
+    ommited = IntField(3, prefix__ommit='\x07')
+    inner   = StructField(4, Inner)
+    tlen    = UIntField(5)
+    text    = StringField(6, length='tlen')
+    items   = ArrayField(7, IntField(0), length='count')
+    name    = NullStringField(8)
+    tail    = StringField(9, length=-1)
+
+class EngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data = struct.pack('<IHB', 0xcafebabe, 7, 2) + struct.pack('<bi', 1, -5) \
+            + struct.pack('<I', 3) + 'kot' + struct.pack('<ii', 10, 20) + 'ala\0' + '!!'
+        self.previous = get_engine()
+
+    def tearDown(self):
+        set_engine(self.previous)
+
+    def unpackWith(self, engine, klass, data):
+        set_engine(engine)
+        return klass.unpack(data)
+
+    def testSameResults(self):
+        for engine in ('interpreter', 'codegen'):
+            s, offset = self.unpackWith(engine, Outer, self.data)
+            self.assertEqual(offset, len(self.data))
+            self.assertEqual((s.magic, s.flags, s.count, s.ommited), (0xcafebabe, 7, 2, None))
+            self.assertEqual((s.inner.kind, s.inner.value), (1, -5))
+            self.assertEqual((s.tlen, s.text, list(s.items)), (3, 'kot', [10, 20]))
+            self.assertEqual((s.name, s.tail), ('ala\0', '!!'))
+            self.assertEqual(s.pack(), self.data)
+
+    def testGenerated(self):
+        decode, pack_into = MetaStruct.generate(Outer)
+        self.assertFalse(isinstance(decode, functools.partial))
+        self.assertEqual(pack_into.__name__, 'pack_into')
+
+    def testErrors(self):
+        set_engine('codegen')
+        broken = self.data[:7] + '\x02' + self.data[8:]
+        self.assertRaises(UnpackException, Outer.unpack, broken)
+        self.assertRaises(UnpackException, Outer.unpack, self.data[:17])
+        self.assertRaises(UnpackException, Outer.unpack, self.data[:-6])
+
+    def testFallback(self):
+        class TestStruct(CStruct):
+            tail_offset = IntField(0)
+            tail        = StringField(1, length=-1, offset='tail_offset')
+
+        decode, pack_into = MetaStruct.generate(TestStruct)
+        self.assertEqual(pack_into.__name__, '_pack_into')
+
+        set_engine('codegen')
+        self.assertEqual(TestStruct(tail='kot').pack(), struct.pack('<i', 4) + 'kot')
+
+    def testUnpackMany(self):
+        frames = self.data + 'xx' + self.data
+        inner = struct.pack('<bibi', 1, 5, 1, 6)
+        for engine in ('interpreter', 'codegen'):
+            set_engine(engine)
+            for lazy in (False, True):
+                result = Outer.unpack_many(frames, [(0, len(self.data)), \
+                    (len(self.data) + 2, len(frames))], lazy)
+                self.assertEqual([s.pack() for (s, _) in result], [self.data] * 2)
+                self.assertEqual([s.tail for (s, _) in result], ['!!'] * 2)
+
+            result = Inner.unpack_many(inner, [0, 5])
+            self.assertEqual([(s.value, offset) for (s, offset) in result], [(5, 5), (6, 10)])
+
+    def testUnknownEngine(self):
+        self.assertRaises(ValueError, set_engine, 'turbo')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,7 +4,7 @@
 import unittest
 import struct
 
-from lqsoft.cstruct.common import CStruct
+from lqsoft.cstruct.common import CStruct, DecodeStatistics, set_tracer
 from lqsoft.cstruct.fields.numeric import *
 from lqsoft.cstruct.constraints import *
 
@@ -135,6 +135,94 @@ class NumericFieldTest(unittest.TestCase):
         
 
 
+    def testFixedRun(self):
+        class TestStruct(CStruct):
+            f1 = IntField(0)
+            f2 = UShortField(1)
+            f3 = UByteField(2)
+            f4 = IntField(3, prefix='\x07')
+            f5 = UIntField(4)
+            f6 = ByteField(5)
+
+        self.assertEqual([str(step) for step in TestStruct._layout], \
+            ['f1,f2,f3', 'f4', 'f5,f6'])
+
+        s = TestStruct(f1=-5, f2=0xcafe, f3=7, f4=7, f5=0xbebafeca, f6=-1)
+        data = s.pack()
+        self.assertEqual(data, struct.pack('<iHBiIb', -5, 0xcafe, 7, 7, 0xbebafeca, -1))
+
+        v, offset = TestStruct.unpack(data)
+        self.assertEqual(offset, len(data))
+        self.assertEqual((v.f1, v.f2, v.f3, v.f4, v.f5, v.f6), \
+            (-5, 0xcafe, 7, 7, 0xbebafeca, -1))
+
+    def testCompiledChecks(self):
+        class TestStruct(CStruct):
+            f1 = UByteField(0)
+            f2 = NumericField(1)
+
+        s = TestStruct(f1=255, f2=-2**40)
+        for value in (256, -1, 'kot', None):
+            self.assertRaises(ValueError, setattr, s, 'f1', value)
+        self.assertRaises(ValueError, setattr, s, 'f2', 'kot')
+        self.assertEqual((s.f1, s.f2), (255, -2**40))
+
+        # the checks are compiled with the class, so the constraints are frozen
+        field = TestStruct._field_order[0]
+        self.assertTrue(isinstance(field.constraints, tuple))
+        self.assertRaises(TypeError, field.add_constraint, NumericBounds(0, 10))
+
+    def testTrustedUnpack(self):
+        calls = []
+        class CountingField(IntField):
+            def set_value(self, obj, value):
+                calls.append(value)
+                return IntField.set_value(self, obj, value)
+
+        class TestStruct(CStruct):
+            f1 = CountingField(0)
+            f2 = IntField(1)
+
+        s, offset = TestStruct.unpack(struct.pack('<ii', 1, 2))
+        self.assertEqual((s.f1, s.f2), (1, 2))
+        self.assertEqual(calls, [])
+
+        # values set by the user are still validated
+        s.f1 = 3
+        TestStruct(f1=4)
+        self.assertEqual(calls, [3, 4])
+
+    def testSlots(self):
+        class TestStruct(CStruct):
+            f1 = IntField(0)
+            f2 = ShortField(1)
+
+        s = TestStruct(f1=1, f2=2)
+        self.assertFalse(hasattr(s, '__dict__'))
+        self.assertRaises(AttributeError, setattr, s, 'f3', 3)
+
+        s.f2 = 5
+        self.assertEqual((s.f1, s.f2), (1, 5))
+        self.assertRaises(ValueError, setattr, s, 'f2', 'kot')
+
+    def testDecodeStatistics(self):
+        class TestStruct(CStruct):
+            f1 = IntField(0)
+            f2 = IntField(1)
+
+        stats = DecodeStatistics()
+        set_tracer(stats)
+        try:
+            TestStruct.unpack(struct.pack('<ii', 1, 2))
+            TestStruct.unpack(struct.pack('<iii', 0, 1, 2), 4)
+        finally:
+            set_tracer(None)
+        TestStruct.unpack(struct.pack('<ii', 1, 2))
+
+        count, size, elapsed = stats.snapshot()['TestStruct']
+        self.assertEqual((count, size), (2, 16))
+        self.assertTrue(elapsed >= 0)
+
     def testBoundViolation(self):
         class A(CStruct):
             f = ByteField(0)
@@ -4,7 +4,7 @@
 import unittest
 import struct
 
-from lqsoft.cstruct.common import CStruct
+from lqsoft.cstruct.common import CStruct, UnpackException
 from lqsoft.cstruct.fields.text import *
 from lqsoft.cstruct.fields.numeric import IntField
 from lqsoft.cstruct.constraints import *
@@ -67,6 +67,59 @@ class StringFieldTest(unittest.TestCase):
         self.assertEqual(s.text, self.svalue)
         self.assertEqual(s.tlen, self.slen)
 
+    def testUnpackView(self):
+        class TestStruct(CStruct):
+            tlen = IntField(0)
+            text = StringField(1, length='tlen')
+            tail = NullStringField(2)
+
+        data = 'JUNK' + self.sdata_ext + 'Ala ma kota\0'
+        s, offset = TestStruct.unpack(memoryview(data), 4)
+        self.assertEqual(offset, len(data))
+
+        # the string is copied out of the buffer on first access
+        self.assertTrue(isinstance(s._text, memoryview))
+        self.assertEqual(s.text, self.svalue)
+        self.assertTrue(isinstance(s._text, str))
+        self.assertEqual(s.tail, 'Ala ma kota\0')
+
+    def testUnterminatedNullString(self):
+        class TestStruct(CStruct):
+            text = NullStringField(0)
+
+        self.assertRaises(UnpackException, TestStruct.unpack, 'Ala ma kota')
+
+    def testOffsetPatching(self):
+        class TestStruct(CStruct):
+            magic       = IntField(0, default=0x7afebabe)
+            sum_offset  = IntField(1)
+            text        = NullStringField(2)
+            tail_offset = IntField(3)
+            tail        = StringField(4, length=-1, offset='tail_offset')
+            checksum    = IntField(5, offset='sum_offset')
+
+        s = TestStruct(text='Ala ma kota\0', tail='!')
+        data = s.pack()
+        # the offset is patched after the field was written
+        self.assertEqual(s.sum_offset, 25)
+        self.assertEqual(s.tail_offset, 24)
+        self.assertEqual(data, struct.pack('<ii', 0x7afebabe, 25) + 'Ala ma kota\0' \
+            + struct.pack('<i', 24) + '!' + struct.pack('<i', 0))
+
+    def testVarchar(self):
+        class TestStruct(CStruct):
+            text        = VarcharField(0)
+            checksum    = IntField(1, default=0x7afebabe)
+
+        data = struct.pack('<I', self.slen) + self.svalue + struct.pack('<i', 0x7afebabe)
+        s, offset = TestStruct.unpack(data)
+        self.assertEqual((s.text, offset), (self.svalue, len(data)))
+        self.assertEqual(TestStruct(text=self.svalue).pack(), data)
+        self.assertEqual(TestStruct(text=CStruct_VarString(text=self.svalue)).pack(), data)
+
+        self.assertRaises(ValueError, TestStruct, text=5)
+        self.assertRaises(UnpackException, TestStruct.unpack, data[:10])
+
     def test0PackNullString(self):
         class TestStruct(CStruct):
             text        = NullStringField(0)
@@ -0,0 +1,125 @@
+# -*- coding: utf-8
+"""Traffic and latency counters of GaduClient connections."""
+
+import time
+import weakref
+
+# latency histograms are filled only when timing is on - received packets
+# are then decoded eagerly, so handlers aren't charged for lazy decoding
+_timing = False
+
+def set_timing(enabled):
+    global _timing
+    _timing = bool(enabled)
+
+def get_timing():
+    return _timing
+
+# upper bounds of histogram buckets, in seconds - the last bucket is open
+BUCKETS = tuple(10.0 ** (exp / 2.0) for exp in xrange(-12, 1))
+
+class Histogram(object):
+    """Counts of measured times in BUCKETS, plus their count and sum."""
+    __slots__ = ('count', 'total', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def add(self, seconds, count=1):
+        self.count += count
+        self.total += seconds * count
+        for (i, bound) in enumerate(BUCKETS):
+            if seconds <= bound:
+                break
+        else:
+            i = len(BUCKETS)
+        self.buckets[i] += count
+
+    def snapshot(self):
+        """Returns (count, seconds, bucket counts)"""
+        return (self.count, self.total, tuple(self.buckets))
+
+class TrafficStatistics(object):
+    """Per packet type counters of a connection: packets and bytes sent and
+        received, received frames rejected as malformed and, while timing is on, time spent decoding received packets
+        and in their handlers, and time sent packets waited in the outgoing
+        queue."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        # packet class name -> [packets, bytes]
+        self.inbound = {}
+        self.outbound = {}
+        self.rejected = {}
+        # packet class name -> Histogram
+        self.decode = {}
+        self.handler = {}
+        self.queue_wait = {}
+
+    def received(self, name, packets, size):
+        entry = self.inbound.get(name)
+        if entry is None:
+            entry = self.inbound[name] = [0, 0]
+        entry[0] += packets
+        entry[1] += size
+
+    def sent(self, name, size):
+        entry = self.outbound.get(name)
+        if entry is None:
+            entry = self.outbound[name] = [0, 0]
+        entry[0] += 1
+        entry[1] += size
+
+    def rejected_frame(self, name, size):
+        """A received frame, that isn't handled, because it's malformed"""
+        entry = self.rejected.get(name)
+        if entry is None:
+            entry = self.rejected[name] = [0, 0]
+        entry[0] += 1
+        entry[1] += size
+
+    def __timing(self, histograms, name, seconds, count):
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = Histogram()
+        histogram.add(seconds, count)
+
+    def decoded(self, name, seconds, count=1):
+        """Time of decoding count packets, each taking seconds on average."""
+        self.__timing(self.decode, name, seconds, count)
+
+    def handled(self, name, seconds, count=1):
+        self.__timing(self.handler, name, seconds, count)
+
+    def waited(self, name, seconds):
+        self.__timing(self.queue_wait, name, seconds, 1)
+
+    def snapshot(self):
+        """Returns a dict of plain values, fit to be dumped as JSON"""
+        histograms = lambda d: dict( (name, h.snapshot()) for (name, h) in d.iteritems() )
+        return {
+            'seconds': time.time() - self.started,
+            'inbound': dict( (name, tuple(e)) for (name, e) in self.inbound.iteritems() ),
+            'outbound': dict( (name, tuple(e)) for (name, e) in self.outbound.iteritems() ),
+            'rejected': dict( (name, tuple(e)) for (name, e) in self.rejected.iteritems() ),
+            'decode': histograms(self.decode),
+            'handler': histograms(self.handler),
+            'queue_wait': histograms(self.queue_wait),
+        }
+
+#
+# Registry of statistics of the live connections
+#
+_connections = weakref.WeakKeyDictionary()
+
+def register(client, stats):
+    _connections[client] = stats
+
+def connections():
+    """Returns (client, TrafficStatistics) of all the live connections"""
+    return _connections.items()
@@ -2,6 +2,8 @@
 __author__="lreqc"
 __date__ ="$2009-07-14 07:33:27$"
 
+from twisted.internet import reactor
+
 from sunshine.lqsoft.pygadu.network_base import StructNotice
 import xml.etree.ElementTree as ET
 import hashlib
@@ -37,24 +39,37 @@ class GaduProfile(object):
     status = property(__get_status, __set_status)
 
     def _updateContact(self, notify):
-        # notify is of class GGStruct_Status80
-        if notify.uin != self.uin:
-            if self.__contacts.has_key(notify.uin):
-                contact = self.__contacts[notify.uin]
-            else:
-                contact_xml = ET.Element("Contact")
-                ET.SubElement(contact_xml, "Guid").text = notify.uin
-                ET.SubElement(contact_xml, "GGNumber").text = notify.uin
-                ET.SubElement(contact_xml, "ShowName").text = "Unknown User"
-                ET.SubElement(contact_xml, "Groups")
-                c = GaduContact.from_xml(contact_xml)
-                self.addContact( c )
-                #contact = GaduContact.simple_make(self, notify.uin, "Unknown User")
-
-            contact.status =  notify.status
-            contact.description = notify.description
+        contact = self.__applyStatus(notify)
+        if contact is not None:
             self.onContactStatusChange(contact)
 
+    def _updateContacts(self, notifies):
+        contacts = [self.__applyStatus(notify) for notify in notifies]
+        contacts = [contact for contact in contacts if contact is not None]
+        if contacts:
+            self.onContactsStatusChange(contacts)
+
+    def __applyStatus(self, notify):
+        # notify is of class GGStruct_Status80
+        if notify.uin == self.uin:
+            return None
+
+        if self.__contacts.has_key(notify.uin):
+            contact = self.__contacts[notify.uin]
+        else:
+            contact_xml = ET.Element("Contact")
+            ET.SubElement(contact_xml, "Guid").text = notify.uin
+            ET.SubElement(contact_xml, "GGNumber").text = notify.uin
+            ET.SubElement(contact_xml, "ShowName").text = "Unknown User"
+            ET.SubElement(contact_xml, "Groups")
+            contact = GaduContact.from_xml(contact_xml)
+            self.addContact( contact )
+            #contact = GaduContact.simple_make(self, notify.uin, "Unknown User")
+
+        contact.status =  notify.status
+        contact.description = notify.description
+        return contact
+
     def _creditials(self, result, *args, **kwargs):
         """Called by protocol, to get creditials, result will be passed to login
             procedure. It should be a 2-tuple with (uin, hash_elem)"""
@@ -73,6 +88,8 @@ class GaduProfile(object):
 
     def disconnect(self):
         print 'Protocol disconnecting'
+        # don't lose packets queued in this reactor turn
+        self.handler._flushPackets()
         self.handler.transport.loseConnection()
 
     def addContact(self, contact):
@@ -125,6 +142,15 @@ class GaduProfile(object):
             raise RuntimeError("You need to be connected, to send messages.")
         self.__connection.sendConfMessage(uin, html_message + '\0', plain_message + '\0', recipients)
 
+    def sendToConference(self, html_message, plain_message, recipients):
+        """Send the message to every recipient of a conference. Returns
+            a Deferred fired, when all the copies have been queued."""
+        if not self.connected:
+            raise RuntimeError("You need to be connected, to send messages.")
+        d = self.__connection.sendConfMessages(recipients, html_message + '\0', plain_message + '\0')
+        d.addErrback(self.__connection._log_failure)
+        return d
+
     def sendTypingNotify(self, uin, type):
         if not self.connected:
             raise RuntimeError("You need to be connected, to send notifies.")
@@ -135,30 +161,45 @@ class GaduProfile(object):
         if not self.connected:
             raise RuntimeError("You need to be connected, to import contact list from the server.")
 
-        def parse_xml(data):
-            print zlib.decompress(data)
-            book = ET.fromstring(zlib.decompress(data))
-            self._flushContacts()
-            
-            for elem in book.find('Groups').getchildren():
-                self.addGroup( GaduContactGroup.from_xml(elem) )
-
-            for elem in book.find('Contacts').getchildren():
-                is_uin_ok = 1
-                try:
-                    check_uin = elem.find("GGNumber")
-                    int(check_uin.text)
-                    if check_uin.text == '':
-                        is_uin_ok = 0
-                except:
+        groups, contacts = [], []
+
+        def on_group(elem):
+            groups.append( GaduContactGroup.from_xml(elem) )
+
+        def on_contact(elem):
+            is_uin_ok = 1
+            try:
+                check_uin = elem.find("GGNumber")
+                int(check_uin.text)
+                if check_uin.text == '':
                     is_uin_ok = 0
-                    
-                if is_uin_ok == 1:
-                    contact = GaduContact.from_xml(elem)
-                    self.addContact( contact )
+            except:
+                is_uin_ok = 0
+
+            if is_uin_ok == 1:
+                contacts.append( GaduContact.from_xml(elem) )
+            else:
+                print 'Failed to import contact. Invalid uin: %s.' % check_uin.text
+
+        def parse_xml(data):
+            # groups and contacts are collected as soon as they're decompressed
+            # and parsed, without building the whole document, but replace the
+            # current ones only if the whole list parses - a broken list leaves
+            # the roster and the server's notify list as they were
+            try:
+                parser = ContactListParser(on_group, on_contact)
+                for pos in xrange(0, len(data), parser.CHUNK):
+                    parser.feed(data[pos:pos + parser.CHUNK])
+                parser.close()
+            except (zlib.error, ET.ParseError), e:
+                self.__connection._log('Failed to import contact list: %s' % e)
+            else:
+                self._flushContacts()
+                for group in groups:
+                    self.addGroup(group)
+                for contact in contacts:
+                    self.addContact(contact)
                     self.__connection.addNewContact(contact)
-                else:
-                    print 'Failed to import contact. Invalid uin: %s.' % check_uin.text
 
             callback()
 
@@ -168,7 +209,9 @@ class GaduProfile(object):
         if not self.connected:
             raise RuntimeError("You need to be connected, to export contacts.")
         data = zlib.compress(xml)
-        self.__connection.exportContactsList(data)
+        # this is called in a thread, but the connection has to be used
+        # from the reactor's one
+        reactor.callFromThread(self.__connection.exportContactsList, data)
 
     def _flushContacts(self):
         self.__contacts = {}
@@ -190,6 +233,11 @@ class GaduProfile(object):
         """Called when a status of a contact has changed."""
         pass
 
+    def onContactsStatusChange(self, contacts):
+        """Called when statuses of many contacts have changed at once."""
+        for contact in contacts:
+            self.onContactStatusChange(contact)
+
     def onMessageReceived(self, message):
         """Called when a message had been received"""
         pass
@@ -229,6 +277,55 @@ class GaduProfile(object):
     def groups(self):
         return self.__groups.itervalues()
 
+class _ContactListTarget(object):
+    """Builds the contact list document, but passes every group and
+        contact element to a handler instead of keeping it."""
+    def __init__(self, handlers):
+        self.__handlers = handlers
+        self.__builder = ET.TreeBuilder()
+        self.__elements = []
+
+    def start(self, tag, attrs):
+        elem = self.__builder.start(tag, attrs)
+        self.__elements.append(elem)
+        return elem
+
+    def end(self, tag):
+        elem = self.__builder.end(tag)
+        self.__elements.pop()
+        # <Root><Groups><Group/>...</Groups><Contacts><Contact/>...</Contacts></Root>
+        if len(self.__elements) == 2 and self.__elements[1].tag in self.__handlers:
+            self.__handlers[self.__elements[1].tag](elem)
+            self.__elements[1].remove(elem)
+        return elem
+
+    def data(self, data):
+        self.__builder.data(data)
+
+    def close(self):
+        return self.__builder.close()
+
+class ContactListParser(object):
+    """Incremental parser of a zlib compressed contact list. Every group
+        and contact is passed to a callback as soon as it's parsed."""
+    CHUNK = 64 * 1024
+
+    def __init__(self, on_group, on_contact):
+        self.__zlib = zlib.decompressobj()
+        self.__parser = ET.XMLParser(target=_ContactListTarget( \
+            {'Groups': on_group, 'Contacts': on_contact}))
+
+    def feed(self, data):
+        """Feed the next part of the compressed list"""
+        while data:
+            xml = self.__zlib.decompress(data, self.CHUNK)
+            data = self.__zlib.unconsumed_tail
+            self.__parser.feed(xml)
+
+    def close(self):
+        self.__parser.feed(self.__zlib.flush())
+        self.__parser.close()
+
 class Def(object):
     def __init__(self, type, default_value, required=False, exportable=True, init=lambda x: x):
         self.type = type
@@ -336,11 +433,8 @@ class GaduContact(FlatXMLObject):
         self.Groups = groups
 
     def get_desc(self):
-        #print 'Tak to get_desc, desctiption.text zwraca: %s a samo description: %s' % (self.description.text, self.description)
-        if self.description.text:
-            return self.description.text
-        else:
-            return ''
+        # descriptions of status packets are plain strings now
+        return self.description or ''
 
 #     @classmethod
 #     def from_request_string(cls, rqs):
@@ -22,9 +22,19 @@ class GaduPacketHeader(CStruct):
 class GaduPacket(CStruct):
     """Wspólna nadklasa dla wszystkich wiadomości w GG"""
     def as_packet(self):
-        data = self.pack()
-        hdr = GaduPacketHeader(msg_type=self.packet_id, msg_length=len(data))
-        return hdr.pack() + data
+        buffer = bytearray(PACKET_HEADER_LENGTH + self.static_size \
+            if self.is_fixed_size else 0)
+        self.packet_into(buffer)
+        return str(buffer)
+
+    def packet_into(self, buffer, offset=0):
+        """Pack the header and the packet into a bytearray at offset. The whole
+            frame is sized once and written in place. Returns the end offset."""
+        end = self.pack_into(buffer, offset + PACKET_HEADER_LENGTH)
+        hdr = GaduPacketHeader(msg_type=self.packet_id, \
+            msg_length=end - offset - PACKET_HEADER_LENGTH)
+        hdr.pack_into(buffer, offset)
+        return end
 
     def __str__(self):
         return self.__class__.__name__
@@ -28,10 +28,23 @@ class Resolver(object):
         
         return decorator
     
+    @classmethod
+    def packets(cls):
+        """Returns (class, id, is_out) of all registered packets,
+            incoming ones first."""
+        return sorted( ((klass, id, is_out) for (klass, (id, is_out)) in cls.__by_class.iteritems()), \
+            key=lambda k: (k[2], k[1]) )
+
+    @classmethod
+    def incoming(cls):
+        """Returns (id, class) of all registered incoming packets - a class
+            can also be registered as an outgoing one."""
+        return sorted(cls.__by_ID_in.iteritems())
+
     @classmethod
     def list_packets(cls):
         print "Listing packets:"
-        for (klass, (id, is_out)) in sorted(cls.__by_class.iteritems(), key=lambda k: (k[1][1],k[1][0])):
+        for (klass, id, is_out) in cls.packets():
             print klass.__name__, hex(id), "(%s)" % (is_out and "OUT" or "IN")
 
     @classmethod
@@ -0,0 +1,171 @@
+# -*- coding: utf-8
+"""Recording and offline replay of the data received by GaduClient.
+
+A capture is written, when GaduClient.capture is set to a CaptureWriter
+(telepathy-sunshine does that, if SUNSHINE_CAPTURE is set - every
+connection writes to SUNSHINE_CAPTURE.<uin>.<unix time>). It can be fed
+back through GaduClient and GaduProfile without the network:
+
+    python -m sunshine.lqsoft.pygadu.replay [--realtime] capture.ggcap
+"""
+
+import json
+import optparse
+import struct
+import sys
+import time
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, succeed
+from twisted.python.failure import Failure
+from twisted.internet.error import ConnectionDone
+
+from sunshine.lqsoft.pygadu import metrics
+from sunshine.lqsoft.pygadu.models import GaduProfile
+from sunshine.lqsoft.pygadu.twisted_protocol import GaduClient
+
+MAGIC = 'GGCAPTURE\x01'
+# seconds since the start of the capture, length of the chunk
+RECORD = struct.Struct('<dI')
+
+class CaptureWriter(object):
+    """Writes received chunks, with their times, to a file."""
+
+    def __init__(self, file):
+        self.file = file
+        self.started = time.time()
+        self.file.write(MAGIC)
+
+    def write(self, data):
+        self.file.write(RECORD.pack(time.time() - self.started, len(data)))
+        self.file.write(data)
+
+    def close(self):
+        self.file.close()
+
+def read_capture(file):
+    """Yields (seconds, chunk) of a capture. A record cut short (by a
+        killed process) ends the capture."""
+    if file.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not a GG capture file.")
+
+    while True:
+        head = file.read(RECORD.size)
+        if len(head) < RECORD.size:
+            return
+        seconds, length = RECORD.unpack(head)
+        data = file.read(length)
+        if len(data) < length:
+            return
+        yield (seconds, data)
+
+class ReplayTransport(object):
+    """Transport of a replayed connection - counts and drops sent data."""
+
+    def __init__(self):
+        self.written = 0
+        self.producer = None
+        self.connected = True
+
+    def write(self, data):
+        self.written += len(data)
+
+    def writeSequence(self, seq):
+        for data in seq:
+            self.write(data)
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def loseConnection(self):
+        self.connected = False
+
+    def getPeer(self):
+        return None
+
+    def getHost(self):
+        return None
+
+def replay(chunks, profile, realtime=False):
+    """Feed captured (seconds, chunk) pairs to a new GaduClient of the
+        profile. Without realtime, all chunks are fed at once. Otherwise
+        they're delivered at their original times by the reactor, that
+        has to be run by the caller. Returns a Deferred fired with the
+        client, after the connection is closed."""
+    client = GaduClient(profile)
+    client.makeConnection(ReplayTransport())
+
+    def finish():
+        client.connectionLost(Failure(ConnectionDone()))
+        return client
+
+    if not realtime:
+        # writes are done at once, the reactor isn't running
+        client.coalesce_writes = False
+        for (_, data) in chunks:
+            client.dataReceived(data)
+        return succeed(finish())
+
+    done = Deferred()
+    chunks = iter(chunks)
+    started = time.time()
+
+    def deliver(data):
+        if data is not None:
+            client.dataReceived(data)
+        for (seconds, data) in chunks:
+            reactor.callLater(max(0.0, started + seconds - time.time()), deliver, data)
+            return
+        done.callback(finish())
+
+    deliver(None)
+    return done
+
+def replay_profile(uin, password=''):
+    """A profile, that can log in with any capture"""
+    profile = GaduProfile(uin)
+    profile.password = password
+    profile.status = 0x014
+    return profile
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [options] capture")
+    parser.add_option('-r', '--realtime', action='store_true', default=False, \
+        help="replay at the original speed, instead of as fast as possible")
+    parser.add_option('-l', '--latency', action='store_true', default=False, \
+        help="measure latencies - received packets are decoded eagerly then")
+    parser.add_option('-u', '--uin', type='int', default=0, \
+        help="number of the replaying profile")
+    (options, args) = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error("Give one capture file.")
+
+    file = open(args[0], 'rb')
+    chunks = list(read_capture(file))
+    file.close()
+    size = sum(len(data) for (_, data) in chunks)
+
+    result = {}
+    def report(client):
+        elapsed = time.time() - start
+        result.update({
+            'chunks': len(chunks), 'bytes': size, 'written': client.transport.written,
+            'seconds': elapsed, 'mb_per_sec': size / elapsed / (1 << 20) if elapsed else None,
+            'stats': client.stats.snapshot(),
+        })
+
+    metrics.set_timing(options.latency)
+    start = time.time()
+    d = replay(chunks, replay_profile(options.uin), options.realtime)
+    d.addCallback(report)
+    if options.realtime:
+        d.addBoth(lambda _: reactor.stop())
+        reactor.run()
+
+    sys.stdout.write(json.dumps(result, sort_keys=True) + '\n')
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
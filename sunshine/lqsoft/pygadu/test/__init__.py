@@ -0,0 +1,2 @@
+__author__="lreqc"
+__date__ ="$2009-07-20 15:35:31$"
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+import os
+import struct
+import tempfile
+import unittest
+import zlib
+
+from twisted.test import proto_helpers
+
+from lqsoft.pygadu.network import *
+from lqsoft.pygadu.models import GaduProfile, GaduContact
+from lqsoft.pygadu.replay import CaptureWriter, read_capture, replay
+from lqsoft.pygadu import twisted_protocol
+from lqsoft.pygadu.twisted_protocol import GaduClient
+
+def status(uin):
+    return StatusUpdatePacket(contact=StructStatus(uin=uin, \
+        status=ChangeStatusPacket.STATUS.AVAILABLE, description='opis %d' % uin)).as_packet()
+
+CONTACT_LIST = '<ContactBook><Groups><Group><Id>g1</Id><Name>Znajomi</Name></Group></Groups>' \
+    '<Contacts><Contact><Guid>5</Guid><GGNumber>5</GGNumber><ShowName>Piec</ShowName></Contact>' \
+    '<Contact><Guid>6</Guid><GGNumber>6</GGNumber><ShowName>Szesc</ShowName></Contact></Contacts>' \
+    '</ContactBook>'
+
+def frames(data):
+    """Returns (msg_type, body) of all the packets in data"""
+    result, pos = [], 0
+    while pos < len(data):
+        msg_type, length = struct.unpack_from('<II', data, pos)
+        result.append( (msg_type, data[pos + 8:pos + 8 + length]) )
+        pos += 8 + length
+    return result
+
+class CountingTransport(proto_helpers.StringTransport):
+    """Remembers the number of write calls"""
+
+    def __init__(self):
+        proto_helpers.StringTransport.__init__(self)
+        self.writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        proto_helpers.StringTransport.write(self, data)
+
+    def writeSequence(self, seq):
+        self.writes += 1
+        proto_helpers.StringTransport.write(self, ''.join(seq))
+
+class RecordingProfile(GaduProfile):
+    """Profile remembering the events it's notified of"""
+
+    def __init__(self, uin):
+        GaduProfile.__init__(self, uin)
+        self.events = []
+
+    def onTypingNotification(self, data):
+        self.events.append( ('typing', data.uin, data.type) )
+
+    def onContactStatusChange(self, contact):
+        self.events.append( ('status', contact.uin) )
+
+    def onContactsStatusChange(self, contacts):
+        self.events.append( ('statuses', [contact.uin for contact in contacts]) )
+
+    def onXmlEvent(self, data):
+        self.events.append( ('xml', data.data) )
+
+class GaduClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.profile = RecordingProfile(1849224)
+        self.client = GaduClient(self.profile)
+        self.client._log = lambda obj: None
+        self.transport = CountingTransport()
+        self.client.makeConnection(self.transport)
+
+    def tearDown(self):
+        # cancels a pending flush of the outgoing queue
+        self.client.connectionLost(None)
+        twisted_protocol.metrics.set_timing(False)
+
+    def testChunkedFraming(self):
+        xml = '<event>%s</event>' % ('x' * 100000)
+        data = status(5) + XmlEventPacket(data=xml).as_packet() + status(6)
+        for size in (1, 3, 1000):
+            del self.profile.events[:]
+            for pos in xrange(0, len(data), size):
+                self.client.dataReceived(data[pos:pos + size])
+            self.assertEqual(self.profile.events, \
+                [('status', 5), ('xml', xml), ('status', 6)])
+
+    def testBatchedFrames(self):
+        data = status(5) + status(6) + status(7) + \
+            MessageAckPacket(msg_status=2, recipient=5, seq=1).as_packet() + status(8)
+        self.client.dataReceived(data)
+        self.assertEqual(self.profile.events, [('statuses', [5, 6, 7]), ('status', 8)])
+
+    def testBatchingDisabled(self):
+        self.client = GaduClient(self.profile)
+        self.client.batch_frames = False
+        self.client._log = lambda obj: None
+        self.client.makeConnection(proto_helpers.StringTransport())
+        self.client.dataReceived(status(5) + status(6))
+        self.assertEqual(self.profile.events, [('status', 5), ('status', 6)])
+
+    def testSkippedFrames(self):
+        # unknown type, no handler, too short
+        data = struct.pack('<II', 0x999, 2) + 'ab' \
+            + struct.pack('<II', UnavailbleAckPacket.packet_id, 0) \
+            + struct.pack('<II', StatusUpdatePacket.packet_id, 1) + 'x' + status(5)
+        self.client.dataReceived(data)
+        self.assertEqual(self.profile.events, [('status', 5)])
+        self.assertEqual(self.client.stats.snapshot()['inbound']['message with type 2457'], (1, 10))
+
+    def testShortFrames(self):
+        short = struct.pack('<II', StatusUpdatePacket.packet_id, 1) + 'x'
+        self.client.dataReceived(short + short)
+        self.assertEqual(self.profile.events, [])
+        stats = self.client.stats.snapshot()
+        self.assertEqual(stats['rejected'], {'StatusUpdatePacket': (2, 2 * len(short))})
+        self.assertEqual(stats['inbound']['StatusUpdatePacket'], (2, 2 * len(short)))
+
+    def testWriteCoalescing(self):
+        for num in (1, 2, 3):
+            self.client.sendMsgAck(num)
+        self.assertEqual(self.transport.value(), '')
+        self.assertEqual(self.client.outgoing_depth[0], 3)
+
+        # end of the reactor turn
+        self.client._flushPackets()
+        self.assertEqual(self.transport.writes, 1)
+        self.assertEqual([msg_type for (msg_type, _) in frames(self.transport.value())], \
+            [RecvMsgAck.packet_id] * 3)
+        self.assertEqual(self.client.outgoing_depth, (0, 0))
+
+    def testUrgentFlush(self):
+        self.client.sendMsgAck(1)
+        self.client.sendTypingNotify(5, TypingNotifyPacket.TYPE.START)
+        # written at once, in order
+        self.assertEqual(self.transport.writes, 1)
+        self.assertEqual([msg_type for (msg_type, _) in frames(self.transport.value())], \
+            [RecvMsgAck.packet_id, TypingNotifyPacket.packet_id])
+
+    def testWatermarks(self):
+        self.client.high_watermark, self.client.low_watermark = 1000, 500
+        # the transport's buffer is full
+        self.client.pauseProducing()
+
+        done = []
+        recipients = range(100, 140)
+        self.client.sendConfMessages(recipients, 'ala\0', 'ala\0').addCallback(done.append)
+        packets, size = self.client.outgoing_depth
+        self.assertTrue(0 < packets < len(recipients))
+        self.assertTrue(1000 < size < 2000)
+        self.assertEqual((self.transport.value(), done), ('', []))
+
+        self.client.resumeProducing()
+        while not done:
+            self.client._flushPackets()
+        self.client._flushPackets()
+        self.assertEqual(done, [True])
+
+        sent = [MessageOutPacket.unpack(body)[0] for (_, body) in frames(self.transport.value())]
+        self.assertEqual(sorted(msg.recipient for msg in sent), recipients)
+        self.assertEqual(list(sent[0].content.attrs.conference.recipients), recipients[1:])
+
+    def testStopProducers(self):
+        self.client.high_watermark = 0
+        self.client.pauseProducing()
+        done = []
+        self.client.sendConfMessages([100, 101, 102], 'ala\0', 'ala\0').addCallback(done.append)
+        self.client.connectionLost(None)
+        self.assertEqual(done, [False])
+
+    def testReplacedExport(self):
+        self.client.high_watermark = 0
+        self.client.pauseProducing()
+        # the queue is congested, the lists wait in their producers
+        self.client.sendMsgAck(1)
+        self.client.exportContactsList('old')
+        self.client.exportContactsList('new')
+
+        self.client.resumeProducing()
+        self.client._flushPackets()
+        sent = [ULRequestPacket.unpack(body)[0] for (msg_type, body) in frames(self.transport.value()) \
+            if msg_type == ULRequestPacket.packet_id]
+        self.assertEqual([(msg.version, msg.data) for msg in sent], [(1, 'new')])
+        self.assertEqual(self.client.clistversion, 1)
+
+    def testTrafficStatistics(self):
+        twisted_protocol.metrics.set_timing(True)
+        self.client.dataReceived(status(5) + status(6))
+        self.client.sendMsgAck(1)
+        self.client._flushPackets()
+
+        stats = self.client.stats.snapshot()
+        self.assertEqual(stats['inbound']['StatusUpdatePacket'], (2, len(status(5) + status(6))))
+        self.assertEqual(stats['outbound']['RecvMsgAck'][0], 1)
+        for kind in ('decode', 'handler'):
+            self.assertEqual(stats[kind]['StatusUpdatePacket'][0], 2)
+        self.assertEqual(stats['queue_wait']['RecvMsgAck'][0], 1)
+
+    def testCaptureReplay(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            data = status(5) + status(6) + TypingNotifyPacket(uin=5, \
+                type=TypingNotifyPacket.TYPE.STOP).as_packet()
+            self.client.capture = CaptureWriter(open(path, 'wb'))
+            for pos in xrange(0, len(data), 7):
+                self.client.dataReceived(data[pos:pos + 7])
+            self.client.connectionLost(None)
+
+            capture = open(path, 'rb')
+            chunks = list(read_capture(capture))
+            capture.close()
+        finally:
+            os.remove(path)
+        self.assertEqual(''.join(chunk for (_, chunk) in chunks), data)
+
+        profile = RecordingProfile(1849224)
+        clients = []
+        replay(chunks, profile).addCallback(clients.append)
+        self.assertEqual(profile.events, self.profile.events)
+        self.assertEqual(clients[0].stats.inbound['StatusUpdatePacket'][0], 2)
+
+    def testTypingNotifyReceived(self):
+        # registered both as an incoming and an outgoing packet
+        self.client.dataReceived(TypingNotifyPacket( \
+            type=TypingNotifyPacket.TYPE.START, uin=5).as_packet())
+        self.assertEqual(self.profile.events, [('typing', 5, TypingNotifyPacket.TYPE.START)])
+
+    def importContacts(self, data):
+        self.profile.addContact(GaduContact(Guid='7', GGNumber='7', ShowName='Siedem'))
+        self.profile._loginSuccess(self.client)
+        done = []
+        self.profile.importContacts(lambda: done.append(True))
+        self.client._flushPackets()
+        self.transport.clear()
+
+        self.client.dataReceived(ULReplyPacket(type=0x00, version=3, data=data).as_packet())
+        self.client._flushPackets()
+        self.assertEqual(done, [True])
+        return [AddNoticePacket.unpack(body)[0].contact.uin \
+            for (msg_type, body) in frames(self.transport.value()) \
+            if msg_type == AddNoticePacket.packet_id]
+
+    def testContactListImport(self):
+        added = self.importContacts(zlib.compress(CONTACT_LIST))
+        self.assertEqual(sorted(contact.uin for contact in self.profile.contacts), [5, 6])
+        self.assertEqual([group.Id for group in self.profile.groups], ['g1'])
+        self.assertEqual(sorted(added), [5, 6])
+
+    def testBrokenContactListImport(self):
+        # the list ends in the middle of a contact
+        added = self.importContacts(zlib.compress(CONTACT_LIST[:200]))
+        self.assertEqual([contact.uin for contact in self.profile.contacts], [7])
+        self.assertEqual(list(self.profile.groups), [])
+        self.assertEqual(added, [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,15 +4,77 @@ __date__ ="$2009-07-14 05:51:00$"
 
 from twisted.internet.defer import Deferred
 from twisted.internet.protocol import Protocol
-from twisted.internet import task
+from twisted.internet import reactor, task
+from twisted.internet.interfaces import IPushProducer
 import twisted.python.log as tlog
+from zope.interface import implements
 
 from sunshine.lqsoft.pygadu.network import *
 from sunshine.lqsoft.pygadu.packets import Resolver
+from sunshine.lqsoft.pygadu import metrics
+from sunshine.lqsoft.cstruct.common import get_tracer
 
 import struct, time
 
+# GaduPacketHeader as a plain struct - (msg_type, msg_length)
+_header = struct.Struct('<II')
+
+class PacketProducer(object):
+    """Sends packets from an iterable through a GaduClient. It's paused,
+        while the client's outgoing queue is over the high watermark."""
+    implements(IPushProducer)
+
+    def __init__(self, client, packets):
+        self.client = client
+        self.done = Deferred()
+        self.__packets = iter(packets)
+        self.__paused = False
+        self.__stopped = False
+
+    def start(self):
+        """Returns a Deferred fired with True when all packets are queued,
+            or with False if the producer was stopped."""
+        self.client.addSendProducer(self)
+        if not self.__paused:
+            self.resumeProducing()
+        return self.done
+
+    def pauseProducing(self):
+        self.__paused = True
+
+    def resumeProducing(self):
+        self.__paused = False
+        while not (self.__paused or self.__stopped):
+            try:
+                packet = self.__packets.next()
+            except StopIteration:
+                self.__finish(True)
+            else:
+                self.client._sendPacket(packet)
+
+    def stopProducing(self):
+        if not self.__stopped:
+            self.__finish(False)
+
+    def __finish(self, sent):
+        self.__stopped = True
+        self.client.removeSendProducer(self)
+        self.done.callback(sent)
+
 class GaduClient(Protocol):
+    implements(IPushProducer)
+
+    # frames of the same type, received together, are decoded in one batch
+    # if there is a _handleBatch<PacketClass> handler for them
+    batch_frames = True
+    # packets sent during one reactor turn are written together
+    coalesce_writes = True
+    # send producers are paused, when this many bytes are waiting to be
+    # written, and resumed after the queue drops below the low watermark
+    high_watermark = 256 * 1024
+    low_watermark = 64 * 1024
+    # a replay.CaptureWriter, recording all the received data
+    capture = None
     
     def __init__(self, profile):
         self.user_profile = profile # the user connected to this client
@@ -33,10 +95,31 @@ class GaduClient(Protocol):
 
         self.msg_id = 0
         self.clistversion = 0
+        self.__dispatch = self.__dispatchTable()
+
+        self.stats = metrics.TrafficStatistics()
+        metrics.register(self, self.stats)
+        self.__exporter = None
 
     def connectionMade(self):
-        self.__buffer = ''        
-        self.__chdr = None
+        # received data is kept as a list of chunks, that are joined only
+        # when there's enough of it for the next frame
+        self.__chunks = []
+        self.__pending = 0
+        self.__needed = PACKET_HEADER_LENGTH
+        # packets waiting for the end of this reactor turn
+        self.__outgoing = []
+        # (packet class name, time of queueing) of the outgoing packets,
+        # while latencies are measured
+        self.__waiting = []
+        self.__flushCall = None
+        self.__queued = 0
+        self.outgoing_peak = 0
+        # the transport pauses us, when it's buffer is full
+        self.__writePaused = False
+        self.__throttled = False
+        self.__producers = []
+        self.transport.registerProducer(self, True)
         # Nie trzeba tu nic robic, bo to server pierwszy wysyła nam wiadomość
 
     def connectionLost(self, reason):
@@ -44,54 +127,216 @@ class GaduClient(Protocol):
             self.__pingThread.stop()
             self.__pingThread = None
 
-        Protocol.connectionLost(self, reason)
+        if self.__flushCall is not None:
+            self.__flushCall.cancel()
+            self.__flushCall = None
+        self.__outgoing = []
+        self.__waiting = []
+        self.__queued = 0
+        self.stopProducing()
 
-    def __pop_data(self, n):
-        data, self.__buffer = self.__buffer[:n], self.__buffer[n:]
-        return data
+        if self.capture is not None:
+            self.capture.close()
+            self.capture = None
 
-    def dataReceived(self, data):
-        self.__buffer += data
-
-        while True:
-            if self.__chdr is not None:
-                # if we are inside of a message
-                hdr = self.__chdr
-
-                if len(self.__buffer) < hdr.msg_length:
-                    # not yet
-                    break
-
-                try:
-                    msg_class = Resolver.by_IDi(hdr.msg_type)
-                except KeyError, e:
-                    self.__pop_data(hdr.msg_length)
-                    self._log('Ommiting message with type %d.' % hdr.msg_type)
-                else:
-                    msg, _ = msg_class.unpack( self.__pop_data(hdr.msg_length) )
-                    self._messageReceived(hdr, msg)
-                finally:
-                    self.__chdr = None                  
-            else:
-                # we're waiting for a header
-                if len(self.__buffer) < PACKET_HEADER_LENGTH:
-                    # no header yet
-                    break
+        Protocol.connectionLost(self, reason)
 
-                self.__chdr, _ = GaduPacketHeader.unpack(\
-                    self.__pop_data(PACKET_HEADER_LENGTH))
-                # continue normally
+    def dataReceived(self, data):
+        if self.capture is not None:
+            self.capture.write(data)
+
+        self.__chunks.append(data)
+        self.__pending += len(data)
+        if self.__pending < self.__needed:
+            # not yet
+            return
+
+        buffer = ''.join(self.__chunks)
+
+        # split off all the complete frames
+        pos, size, frames = 0, len(buffer), []
+        unpack_header = _header.unpack_from
+        self.__needed = PACKET_HEADER_LENGTH
+        while size - pos >= PACKET_HEADER_LENGTH:
+            msg_type, msg_length = unpack_header(buffer, pos)
+            start = pos + PACKET_HEADER_LENGTH
+            end = start + msg_length
+            if end > size:
+                # wait for the whole body
+                self.__needed = end - pos
+                break
+            frames.append( (msg_type, start, end) )
+            pos = end
+
+        # only the incomplete frame at the end is copied
+        rest = buffer[pos:]
+        self.__chunks = rest and [rest] or []
+        self.__pending = len(rest)
+
+        view, i = memoryview(buffer), 0
+        while i < len(frames):
+            j = i + 1
+            if self.batch_frames:
+                while j < len(frames) and frames[j][0] == frames[i][0]:
+                    j += 1
+            self._framesReceived(view, frames[i:j])
+            i = j
 
         # end of data loop
+
+    def _framesReceived(self, data, frames):
+        """Decode and handle frames of one type: (msg_type, start, end) of each"""
+        msg_type = frames[0][0]
+        size = sum(end - start for (_, start, end) in frames) + PACKET_HEADER_LENGTH * len(frames)
+        try:
+            msg_class, handler, batch_handler = self.__dispatch[msg_type]
+        except KeyError, e:
+            # not decoded at all
+            try:
+                name = Resolver.by_IDi(msg_type).__name__
+            except KeyError, e:
+                name = 'message with type %d' % msg_type
+            self.stats.received(name, len(frames), size)
+            self._log('Omitting %s (%d), there is no handler for it.' % (name, len(frames)))
+            return
+        name = msg_class.__name__
+        self.stats.received(name, len(frames), size)
+
+        valid = []
+        for (_, start, end) in frames:
+            if end - start < msg_class.static_size:
+                self.stats.rejected_frame(name, end - start + PACKET_HEADER_LENGTH)
+                self._log('Omitting %s with length %d, shorter than %d.' % \
+                    (name, end - start, msg_class.static_size))
+            else:
+                valid.append( (start, end) )
+
+        timed = metrics.get_timing()
+        if batch_handler is not None and len(valid) > 1:
+            # batch handlers read every message, so they're decoded eagerly,
+            # all with the same decode function
+            count = len(valid)
+            decoding = timed and time.time()
+            msgs = msg_class.unpack_many(data, valid)
+            handling = timed and time.time()
+            batch_handler([msg for (msg, _) in msgs])
+            if timed:
+                # times per message
+                self.stats.decoded(name, (handling - decoding) / count, count)
+                self.stats.handled(name, (time.time() - handling) / count, count)
+            return
+
+        # fixed-size messages are cheap to decode at once, other fields
+        # are decoded only when a handler reads them - unless decoding is
+        # measured, so it's not charged to the handler
+        lazy = not (msg_class.is_fixed_size or timed or get_tracer() is not None)
+        for (start, end) in valid:
+            decoding = timed and time.time()
+            msg, _ = msg_class.unpack(data[start:end], lazy=lazy)
+            handling = timed and time.time()
+            handler(msg)
+            if timed:
+                self.stats.decoded(name, handling - decoding)
+                self.stats.handled(name, time.time() - handling)
+
+    def __dispatchTable(self):
+        """Maps msg_type of every incoming packet, that has a handler, to
+            (packet class, handler, batch handler or None)"""
+        table = {}
+        for (id, klass) in Resolver.incoming():
+            handler = getattr(self, '_handle' + klass.__name__, None)
+            if handler is None:
+                continue
+            batch_handler = None
+            if self.batch_frames:
+                batch_handler = getattr(self, '_handleBatch' + klass.__name__, None)
+            table[id] = (klass, handler, batch_handler)
+        return table
     
-    def _sendPacket(self, msg):
+    def _sendPacket(self, msg, urgent=False):
+        """Queue a packet to be written at the end of the reactor turn.
+            Urgent packets (and the ones queued before them) are written
+            immediately."""
         # wrap the packet with a transport header
-        self.transport.write( msg.as_packet() )
-
-    def _messageReceived(self, hdr, msg):
-        """Called when a full GG message has been received"""        
-        self._log("Calling action: " + msg.__class__.__name__)
-        getattr(self, '_handle' + msg.__class__.__name__, self._log)(msg)
+        data = msg.as_packet()
+        self.__outgoing.append(data)
+        if metrics.get_timing():
+            self.__waiting.append( (msg.__class__.__name__, time.time()) )
+        self.stats.sent(msg.__class__.__name__, len(data))
+        self.__queued += len(data)
+        self.outgoing_peak = max(self.outgoing_peak, self.__queued)
+        if self.__queued > self.high_watermark and not self.__throttled:
+            self.__setThrottled(True)
+
+        if urgent or not self.coalesce_writes:
+            self._flushPackets()
+        elif self.__flushCall is None:
+            self.__flushCall = reactor.callLater(0, self._flushPackets)
+
+    def _flushPackets(self):
+        """Write all the queued packets, with a single call."""
+        if self.__flushCall is not None:
+            if self.__flushCall.active():
+                self.__flushCall.cancel()
+            self.__flushCall = None
+
+        if self.__writePaused:
+            # resumeProducing() will flush
+            return
+
+        outgoing, self.__outgoing = self.__outgoing, []
+        waiting, self.__waiting = self.__waiting, []
+        self.__queued = 0
+        now = time.time()
+        for (name, queued) in waiting:
+            self.stats.waited(name, now - queued)
+        if len(outgoing) == 1:
+            self.transport.write(outgoing[0])
+        elif outgoing:
+            self.transport.writeSequence(outgoing)
+
+        if self.__throttled and self.__queued < self.low_watermark:
+            self.__setThrottled(False)
+
+    @property
+    def outgoing_depth(self):
+        """Number of packets and bytes waiting in the outgoing queue"""
+        return (len(self.__outgoing), self.__queued)
+
+    # flow control - the transport is our consumer, and we're the one
+    # of the producers sending packets
+    def pauseProducing(self):
+        self.__writePaused = True
+
+    def resumeProducing(self):
+        self.__writePaused = False
+        self._flushPackets()
+
+    def stopProducing(self):
+        for producer in list(self.__producers):
+            producer.stopProducing()
+
+    def addSendProducer(self, producer):
+        """Register an IPushProducer, that sends packets through this client."""
+        self.__producers.append(producer)
+        if self.__throttled:
+            producer.pauseProducing()
+
+    def removeSendProducer(self, producer):
+        self.__producers.remove(producer)
+
+    def __setThrottled(self, throttled):
+        self.__throttled = throttled
+        self._log('%s send producers, %d bytes queued.' % \
+            (throttled and 'Pausing' or 'Resuming', self.__queued))
+        for producer in list(self.__producers):
+            if self.__throttled != throttled:
+                # a resumed producer filled the queue again
+                break
+            if throttled:
+                producer.pauseProducing()
+            else:
+                producer.resumeProducing()
 
     # handlers
     def _handleWelcomePacket(self, msg):
@@ -137,13 +382,18 @@ class GaduClient(Protocol):
     def _handleUserDataPacket(self, data):
         self.user_profile.onUserData(data)
 
+    def _handleBatchStatusUpdatePacket(self, msgs):
+        # a burst of status changes, like the one after login
+        self.user_profile._updateContacts([msg.contact for msg in msgs])
+
     def _handleStatusUpdatePacket(self, msg):
         self.user_profile._updateContact(msg.contact)
         
     def _handleStatusNoticiesPacket(self, msg):
         print 'Server sent - noticies packet'
         self.user_profile.onStatusNoticiesRecv()
-        for struct in msg.contacts:
+        # big replies are decoded contact by contact, as they are handled
+        for struct in msg.iter_items('contacts'):
             self.user_profile._updateContact(struct)
 
     def _handleMessageInPacket(self, msg):
@@ -199,15 +449,30 @@ class GaduClient(Protocol):
         #        type = ULRequestPacket.TYPE.PUT_MORE
         #    self._sendPacket(klass(type = type, data = batch))
         
+        exporter = PacketProducer(self, self.__exportPackets(klass, xml))
+        if self.__exporter is not None:
+            # a newer list replaces the one still waiting to be sent
+            self.__exporter.stopProducing()
+        self.__exporter = exporter
+        exporter.start().addCallbacks(self.__exportDone, self._log_failure, \
+            callbackArgs=(exporter,))
+
+    def __exportPackets(self, klass, xml):
+        # the version is taken when the list is queued - an export replaced,
+        # while still waiting, doesn't use one up
         self.clistversion = self.clistversion+1
-        
-        self._sendPacket(klass(type = ULRequestPacket.TYPE.PUT, version = self.clistversion, data = xml))
-        self._log("All contacts exported.")
+        yield klass(type = ULRequestPacket.TYPE.PUT, version = self.clistversion, data = xml)
+
+    def __exportDone(self, sent, exporter):
+        if self.__exporter is exporter:
+            self.__exporter = None
+        if sent:
+            self._log("All contacts exported.")
 
     def sendPing(self):
         print '[PING]'
         if self.firstPing != True:
-            self._sendPacket( Resolver.by_name('PingPacket')() )
+            self._sendPacket( Resolver.by_name('PingPacket')(), urgent=True )
         self.firstPing = False
 
     def sendMsgAck(self, num):
@@ -229,9 +494,9 @@ class GaduClient(Protocol):
 
     def sendTypingNotify(self, uin, type):
         klass = Resolver.by_name('TypingNotifyPacket')
-        self._sendPacket(klass(uin=uin, type=type))
+        self._sendPacket(klass(uin=uin, type=type), urgent=True)
 
-    def sendConfMessage(self, rcpt, html_text, plain_message, contacts):
+    def __confMessage(self, rcpt, html_text, plain_message, contacts):
         klass = Resolver.by_name('MessageOutPacket')
 
         attrs = StructMsgAttrs()
@@ -247,7 +512,18 @@ class GaduClient(Protocol):
             html_message=html_text, plain_message=plain_message, \
             attrs = attrs)
 
-        self._sendPacket( klass( recipient=rcpt, seq=int(time.time()), content=payload) )
+        return klass( recipient=rcpt, seq=int(time.time()), content=payload)
+
+    def sendConfMessage(self, rcpt, html_text, plain_message, contacts):
+        self._sendPacket( self.__confMessage(rcpt, html_text, plain_message, contacts) )
+
+    def sendConfMessages(self, recipients, html_text, plain_message):
+        """Send a conference message to each of the recipients, with the
+            others as the conference. Returns PacketProducer.done"""
+        recipients = sorted(map(int, recipients))
+        packets = (self.__confMessage(rcpt, html_text, plain_message, \
+            [other for other in recipients if other != rcpt]) for rcpt in recipients)
+        return PacketProducer(self, packets).start()
 
     def sendImportRequest(self, callback):
         if self.importrq_cb is not None:
@@ -256,7 +532,6 @@ class GaduClient(Protocol):
         self.importrq_cb = Deferred()
         self.importrq_cb.addCallbacks(lambda result, *args, **kwargs: callback(result), self._log_failure)
         self.importrq_cb.addErrback(self._log_failure)
-        self.import_buf = ''
         
         klass = Resolver.by_name('ULRequestPacket')
         self._sendPacket( klass(type=klass.TYPE.GET, data='') )
@@ -327,12 +602,11 @@ class GaduClient(Protocol):
                 self._warn("Unexpected UL_GET reply")
                 return
 
-            self.import_buf = msg.data
-
             cb = self.importrq_cb
             self.importrq_cb = None
             self.clistversion = msg.version
-            cb.callback(self.import_buf)
+            # the compressed list is parsed incrementally by the profile
+            cb.callback(msg.data)
         elif msg.type == 0x10:
             self.clistversion = msg.version
         elif msg.type == 0x12: